@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the number of scaling iterations and the solve time of the OT solvers
+on random point clouds, for several values of epsilon and lambda1.
+
+    python benchmarks/solver_iterations.py --ncells 1000 --tolerance 1e-6
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import wot.ot
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark the scaling iterations of the OT solvers')
+    parser.add_argument('--ncells', type=int, default=500, help='Number of cells at each timepoint')
+    parser.add_argument('--dimensions', type=int, default=30, help='Number of dimensions of the point clouds')
+    parser.add_argument('--epsilon', default='0.05,0.01', help='Comma separated values of epsilon')
+    parser.add_argument('--lambda1', default='1,10', help='Comma separated values of lambda1')
+    parser.add_argument('--lambda2', type=float, default=50)
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    parser.add_argument('--solvers', default='stable,accelerated', help='Comma separated solvers to compare')
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(0)
+    x = random_state.randn(args.ncells, args.dimensions)
+    y = random_state.randn(args.ncells, args.dimensions) + 0.3
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, y)
+
+    rows = []
+    for epsilon in [float(e) for e in args.epsilon.split(',')]:
+        for lambda1 in [float(l) for l in args.lambda1.split(',')]:
+            reference = None
+            for solver in args.solvers.split(','):
+                start = time.time()
+                tmap, duals = wot.ot.transport_stable_learn_growth(C, lambda1, args.lambda2, epsilon, 3000,
+                                                                    np.ones(args.ncells), epsilon0=1, tau=10000,
+                                                                    growth_iters=3, inner_iter_max=50,
+                                                                    tolerance=args.tolerance, solver=solver,
+                                                                    log=True)
+                elapsed = time.time() - start
+                reference = tmap if reference is None else reference
+                rows.append({'epsilon': epsilon, 'lambda1': lambda1, 'solver': solver, 'iterations': duals['n_iter'],
+                             'time': elapsed,
+                             'max_relative_difference': np.max(np.abs(tmap - reference)) / np.max(reference)})
+    with pd.option_context('display.width', 120):
+        print(pd.DataFrame(rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ requirements = [
 
 extras_require = {
     # 'GRN': ["'gslrandom>=0.1'", 'numexpr']
+    'numba': ['numba'],
+    'parallel': ['threadpoolctl']
 }
 
 setup_requirements = [
@@ -1,13 +1,26 @@
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
 import unittest
 
+import anndata
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import scipy.stats
 import sklearn.metrics
 
+import wot.io
 import wot.ot
 
 
+def compute_all_transport_maps_in_queue(ds, tmap_out):
+    wot.ot.OTModel(ds, tmap_out, local_pca=0, work_queue=True).compute_all_transport_maps()
+
+
 class TestOT(unittest.TestCase):
     """Tests for `wot` package."""
 
@@ -57,6 +70,567 @@ class TestOT(unittest.TestCase):
             self.assertTrue(sum > last)
             last = sum
 
+    def test_transport_stablev2_tolerance(self):
+        # stopping early on convergence should give the same transport map as running all iterations
+        np.random.seed(0)
+        m1 = np.random.rand(30, 5)
+        m2 = np.random.rand(40, 5)
+        cost_matrix = sklearn.metrics.pairwise.pairwise_distances(m1, Y=m2, metric='sqeuclidean')
+        cost_matrix = cost_matrix / np.median(cost_matrix)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 3000, 'g': np.ones(m1.shape[0]),
+                  'tau': 10000, 'epsilon0': 1, 'growth_iters': 3, 'inner_iter_max': 50}
+        full = wot.ot.transport_stable_learn_growth(cost_matrix, **config)
+        early = wot.ot.transport_stable_learn_growth(cost_matrix, tolerance=1e-6, **config)
+        np.testing.assert_allclose(early, full, rtol=1e-4, atol=1e-6 * full.max())
+
+    def test_float32_precision(self):
+        # single precision should agree with the double precision solver
+        np.random.seed(0)
+        m1 = np.random.rand(30, 5)
+        m2 = np.random.rand(40, 5)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 3000, 'g': np.ones(m1.shape[0]),
+                  'tau': 10000, 'epsilon0': 1, 'growth_iters': 3, 'inner_iter_max': 50}
+        tmaps = {}
+        for precision in ['float64', 'float32']:
+            cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2, precision=precision)
+            self.assertEqual(cost_matrix.dtype, np.dtype(precision))
+            tmaps[precision] = wot.ot.transport_stable_learn_growth(cost_matrix, precision=precision, **config)
+            self.assertEqual(tmaps[precision].dtype, np.dtype(precision))
+        np.testing.assert_allclose(tmaps['float32'], tmaps['float64'], rtol=1e-3,
+                                   atol=1e-4 * tmaps['float64'].max())
+
+    def test_log_domain_solver(self):
+        # the log-domain solver performs the same iterations as the stabilized solver
+        np.random.seed(0)
+        m1 = np.random.rand(30, 5)
+        m2 = np.random.rand(40, 5)
+        cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 500, 'g': np.ones(m1.shape[0]),
+                  'tau': 10000, 'epsilon0': 1, 'growth_iters': 2, 'inner_iter_max': 50}
+        stable = wot.ot.transport_stable_learn_growth(cost_matrix, solver='stable', **config)
+        log = wot.ot.transport_stable_learn_growth(cost_matrix, solver='log', block_size=7, **config)
+        np.testing.assert_allclose(log, stable, rtol=1e-6, atol=1e-10)
+
+    def test_accelerated_solver(self):
+        # over-relaxation converges to the same transport map in fewer iterations
+        np.random.seed(0)
+        m1 = np.random.rand(100, 5)
+        m2 = np.random.rand(120, 5)
+        cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2)
+        config = {'lambda1': 10, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 3000, 'g': np.ones(m1.shape[0]),
+                  'tau': 10000, 'epsilon0': 1, 'growth_iters': 1, 'inner_iter_max': 50, 'tolerance': 1e-6,
+                  'log': True}
+        stable, stable_log = wot.ot.transport_stable_learn_growth(cost_matrix, solver='stable', **config)
+        accelerated, accelerated_log = wot.ot.transport_stable_learn_growth(cost_matrix, solver='accelerated',
+                                                                            **config)
+        np.testing.assert_allclose(accelerated, stable, rtol=1e-4, atol=1e-6 * stable.max())
+        self.assertLess(accelerated_log['n_iter'], stable_log['n_iter'])
+
+    def test_scaling_kernels(self):
+        np.random.seed(0)
+        sums, factors = np.random.rand(20) + 0.5, np.random.rand(20)
+        out = np.empty(20)
+        largest = wot.ot.update_scaling(sums, factors, 0.95, out)
+        np.testing.assert_allclose(out, factors / sums ** 0.95)
+        self.assertAlmostEqual(largest, out.max())
+        x, x_hat = np.random.rand(20) + 0.5, np.random.rand(20) + 0.5
+        expected = x ** -0.5 * x_hat ** 1.5
+        wot.ot.extrapolate(x, x_hat, 1.5)
+        np.testing.assert_allclose(x, expected)
+
+    def test_tiled_kernel(self):
+        np.random.seed(0)
+        m1, m2 = np.random.rand(300, 5), np.random.rand(400, 5)
+        cost_matrix = wot.ot.squared_distances(m1, m2, out=np.empty((300, 400)))
+        np.testing.assert_allclose(cost_matrix, sklearn.metrics.pairwise.pairwise_distances(m1, m2, 'sqeuclidean'),
+                                   atol=1e-12)
+        u, v = np.random.rand(300), np.random.rand(400)
+        kernel = np.empty((300, 400))
+        self.assertIs(wot.ot.stabilized_kernel(cost_matrix, u, v, 0.5, out=kernel), kernel)
+        np.testing.assert_allclose(kernel, np.exp((u[:, np.newaxis] + v - cost_matrix) / 0.5))
+        # wide matrices keep tiles of several rows
+        self.assertEqual(wot.ot.row_tiles((100, 40000)), [slice(0, 64), slice(64, 100)])
+
+    def test_sparse_cost_matrix(self):
+        m1 = scipy.sparse.random(300, 1000, density=0.05, format='csr', random_state=0)
+        m2 = scipy.sparse.random(400, 1000, density=0.05, format='csr', random_state=1)
+        dense = wot.ot.OTModel.compute_default_cost_matrix(m1.toarray(), m2.toarray())
+        np.testing.assert_allclose(wot.ot.OTModel.compute_default_cost_matrix(m1, m2), dense, atol=1e-12)
+        cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2, precision='float32', median_sample_size=20000)
+        self.assertEqual(cost_matrix.dtype, np.float32)
+        np.testing.assert_allclose(cost_matrix, dense, rtol=0.02)
+
+    def test_compute_pca(self):
+        # the randomized PCA of sparse matrices matches the exact PCA of the centered dense matrix
+        np.random.seed(0)
+        x = scipy.sparse.csr_matrix(np.random.binomial(1, 0.3, (600, 5))).dot(
+            scipy.sparse.random(5, 80, density=0.3, format='csr', random_state=0))
+        p0, p1, pca, mean = wot.ot.compute_pca(x[:70], x[70:], 5)
+        centered = x.toarray() - x.toarray().mean(axis=0)
+        centered -= centered.mean(axis=1, keepdims=True)
+        u, s, vt = np.linalg.svd(centered, full_matrices=False)
+        np.testing.assert_allclose(pca.singular_values_, s[:5], rtol=1e-6)
+        coordinates = np.vstack((p0, p1)) * pca.singular_values_
+        np.testing.assert_allclose(sklearn.metrics.pairwise.pairwise_distances(coordinates),
+                                   sklearn.metrics.pairwise.pairwise_distances(u[:, :5] * s[:5]), atol=1e-6)
+        np.testing.assert_allclose(wot.ot.project_on_pca(pca, mean, x[:70]), p0, atol=1e-6)
+        np.testing.assert_allclose(wot.ot.compute_pca(x[:70].toarray(), x[70:].toarray(), 5)[0], p0)
+
+    def test_compute_pca_full_rank(self):
+        # small full-rank matrices use the exact SVD, as sklearn's PCA
+        np.random.seed(0)
+        x = np.random.rand(150, 80)
+        p0, p1, pca, mean = wot.ot.compute_pca(x[:70], x[70:], 30)
+        centered = x - x.mean(axis=0)
+        centered -= centered.mean(axis=1, keepdims=True)
+        u, s, vt = np.linalg.svd(centered, full_matrices=False)
+        np.testing.assert_allclose(pca.singular_values_, s[:30], rtol=1e-10)
+        coordinates = np.vstack((p0, p1))
+        signs = np.sign(np.sum(coordinates * u[:, :30], axis=0))
+        np.testing.assert_allclose(coordinates * signs, u[:, :30], atol=1e-10)
+        np.testing.assert_allclose(wot.ot.project_on_pca(pca, mean, x[70:]), p1, atol=1e-10)
+
+    def test_embedding_cache(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(50, 20), pd.DataFrame(index=['c' + str(i) for i in range(50)],
+                                                                  data={'day': [0] * 20 + [1] * 30}))
+        p0, p1 = ds[ds.obs['day'] == 0], ds[ds.obs['day'] == 1]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            x0, x1, pca, mean = wot.ot.EmbeddingCache(tmp_dir).compute_pca(p0, p1, 5)
+            np.testing.assert_allclose(x0, wot.ot.compute_pca(p0.X, p1.X, 5)[0])
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            # a new cache reads the embedding saved on disk
+            cached = wot.ot.EmbeddingCache(tmp_dir).compute_pca(p0, p1, 5)
+            np.testing.assert_array_equal(cached[1], x1)
+            np.testing.assert_array_equal(cached[2].components_, pca.components_)
+            # a different gene filter computes a new embedding
+            wot.ot.EmbeddingCache(tmp_dir).compute_pca(p0[:, :10], p1[:, :10], 5)
+            self.assertEqual(len(os.listdir(tmp_dir)), 2)
+        # each set of cells and genes is only hashed once
+        cache = wot.ot.EmbeddingCache(matrix=ds)
+        for i in range(2):
+            cache.compute_pca(p0, p1, 5)
+            cache.compute_pca(p0, p1, 3)
+        self.assertEqual(list(cache.fingerprints.values()), [wot.ot.EmbeddingCache.fingerprint('', ds)])
+        x0, x1, pca, mean = wot.ot.EmbeddingCache(matrix=ds).compute_pca(p0, p1, 5)
+        np.testing.assert_allclose(np.vstack((x0, x1)), wot.ot.compute_pca(ds.X, ds.X[:0], 5)[0])
+
+    def test_sampled_median(self):
+        np.random.seed(0)
+        m1, m2 = np.random.rand(300, 5), np.random.rand(400, 5)
+        exact = wot.ot.OTModel.compute_default_cost_matrix(m1, m2)
+        sampled = wot.ot.OTModel.compute_default_cost_matrix(m1, m2, median_sample_size=20000)
+        np.testing.assert_allclose(sampled, exact, rtol=0.02)
+        np.testing.assert_array_equal(wot.ot.OTModel.compute_default_cost_matrix(m1, m2, median_sample_size=20000),
+                                      sampled)
+
+        # the cost matrix can be built in a temporary memory-mapped file
+        ds = anndata.AnnData(np.vstack((m1, m2)), pd.DataFrame(index=['c' + str(i) for i in range(700)],
+                                                                data={'day': [0.0] * 300 + [1.0] * 400}))
+        config = {'t0': 0.0, 't1': 1.0, 'local_pca': 0, 'median_sample_size': 20000}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            C, p0, p1 = wot.ot.OTModel.prepare_transport_problem(ds, {**config, 'cost_matrix_dir': tmp_dir})
+            self.assertIsInstance(C, np.memmap)
+            self.assertEqual(os.listdir(tmp_dir), [])
+            np.testing.assert_array_equal(C, sampled)
+            del C
+
+    def test_sparse_solver(self):
+        # keeping every kernel entry gives the dense result, truncating gives a sparse transport map
+        np.random.seed(0)
+        m1 = np.random.rand(30, 5)
+        m2 = np.random.rand(40, 5)
+        cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 500, 'g': np.ones(m1.shape[0]),
+                  'tau': 10000, 'epsilon0': 1, 'growth_iters': 2, 'inner_iter_max': 50}
+        dense = wot.ot.transport_stable_learn_growth(cost_matrix, **config)
+        full = wot.ot.transport_stable_learn_growth(cost_matrix, solver='sparse', kernel_threshold=0, **config)
+        np.testing.assert_allclose(full.toarray(), dense, rtol=1e-6, atol=1e-10)
+        with self.assertRaises(ValueError):
+            wot.ot.sparsify_cost_matrix(cost_matrix, 0.05, -1)
+
+        knn_cost = wot.ot.OTModel.compute_knn_cost_matrix(m1, m2, 5)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(knn_cost))
+        self.assertTrue(np.all(knn_cost.getnnz(axis=0) >= 5) and np.all(knn_cost.getnnz(axis=1) >= 5))
+        tmap = wot.ot.transport_stable_learn_growth(knn_cost, solver='sparse', **config)
+        self.assertEqual(tmap.nnz, knn_cost.nnz)
+
+    def test_multiscale_cost_matrix(self):
+        # the transport map restricted to the coarse support stays close to the full transport map
+        np.random.seed(0)
+        centers = np.random.rand(5, 5) * 4
+        m1 = centers[np.arange(300) % 5] + np.random.rand(300, 5)
+        m2 = centers[np.arange(250) % 5] + np.random.rand(250, 5)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 3000, 'tau': 10000, 'epsilon0': 1,
+                  'growth_iters': 3, 'inner_iter_max': 50, 'g': np.ones(300)}
+        dense = wot.ot.transport_stable_learn_growth(wot.ot.OTModel.compute_default_cost_matrix(m1, m2), **config)
+        cost_matrix = wot.ot.OTModel.compute_multiscale_cost_matrix(m1, m2, 20, config)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(cost_matrix))
+        self.assertLess(cost_matrix.nnz, 300 * 250)
+        self.assertIsNotNone(config['duals'])
+        tmap = wot.ot.transport_stable_learn_growth(cost_matrix, solver='sparse', kernel_threshold=0, **config)
+        self.assertLess(np.abs(tmap.toarray() - dense).sum() / dense.sum(), 0.05)
+
+    def test_coreset_cost_matrix(self):
+        # cells of tight clusters get nearly the same transport map from their representative
+        np.random.seed(0)
+        centers = np.random.rand(5, 5) * 4
+        m1 = centers[np.arange(300) % 5] + np.random.rand(300, 5) * 0.01
+        m2 = centers[np.arange(250) % 5] + np.random.rand(250, 5) * 0.01
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 3000, 'tau': 10000, 'epsilon0': 1,
+                  'growth_iters': 3, 'inner_iter_max': 50, 'g': np.ones(300)}
+        dense = wot.ot.transport_stable_learn_growth(wot.ot.OTModel.compute_default_cost_matrix(m1, m2), **config)
+        cost_matrix = wot.ot.OTModel.compute_coreset_cost_matrix(m1, m2, 5, config)
+        self.assertEqual(cost_matrix.shape, (5, 5))
+        np.testing.assert_allclose(config['dx'], 0.2)
+        labels = config.pop('coreset_labels')
+        tmap, duals = wot.ot.transport_stable_learn_growth(cost_matrix, log=True, **config)
+        tmap, duals = wot.ot.OTModel.lift_transport_map(tmap, duals, *labels)
+        self.assertEqual(tmap.shape, (300, 250))
+        self.assertEqual(len(duals['v']), 250)
+        self.assertLess(np.abs(tmap - dense).sum() / dense.sum(), 0.05)
+        # the log-domain solver weights the representatives the same way
+        config.update({'dx': np.array([0.1, 0.3, 0.2, 0.25, 0.15]), 'dy': np.array([0.3, 0.1, 0.2, 0.2, 0.2]),
+                       'tolerance': 1e-10})
+        np.testing.assert_allclose(wot.ot.transport_stable_learn_growth(cost_matrix, solver='log', **config),
+                                   wot.ot.transport_stable_learn_growth(cost_matrix, **config), rtol=1e-6)
+        ds = anndata.AnnData(np.vstack((m1, m2)), pd.DataFrame(index=['c' + str(i) for i in range(550)],
+                                                               data={'day': [0.0] * 300 + [1.0] * 250}))
+        model = wot.ot.OTModel(ds, None, local_pca=0, coreset=5, solver='log')
+        tmap = wot.ot.OTModel.compute_single_transport_map(ds, {**model.ot_config, 't0': 0.0, 't1': 1.0})
+        self.assertEqual(tmap.shape, (300, 250))
+
+    def test_nystrom_solver(self):
+        # with every cell as a landmark, the low-rank kernel gives the same transport map as the full kernel
+        np.random.seed(0)
+        m1, m2 = np.random.rand(100, 3), np.random.rand(80, 3)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.5, 'scaling_iter': 1000, 'tau': 10000, 'epsilon0': 1,
+                  'growth_iters': 2, 'inner_iter_max': 50, 'g': np.ones(100)}
+        cost = wot.ot.OTModel.compute_landmark_cost(m1, m2, 180)
+        dense = wot.ot.transport_stable_learn_growth(cost.toarray(), **config)
+        tmap = wot.ot.transport_stable_learn_growth(cost, solver='nystrom', **config)
+        self.assertIsInstance(tmap, wot.ot.LowRankMatrix)
+        self.assertLessEqual(tmap.left.shape[1], 180)
+        np.testing.assert_allclose(tmap.toarray(), dense, rtol=1e-3, atol=1e-6)
+        with self.assertRaises(ValueError):
+            wot.ot.transport_stable_learn_growth(cost.toarray(), solver='nystrom', **config)
+        # with few landmarks on full-rank data, the approximate kernel has negative entries
+        m1, m2 = np.random.rand(100, 20), np.random.rand(80, 20)
+        tmap = wot.ot.transport_stable_learn_growth(wot.ot.OTModel.compute_landmark_cost(m1, m2, 20),
+                                                    solver='nystrom', **config)
+        self.assertLess(np.min(tmap.left.dot(tmap.right.T)), 0)
+        dense = tmap.toarray()
+        self.assertGreaterEqual(np.min(dense), 0)
+        np.testing.assert_allclose(dense.sum(axis=1), tmap.sum(axis=1), rtol=1e-6)
+
+        # OTModel records the densification, or only saves the factors
+        ds = anndata.AnnData(np.vstack((m1, m2)), pd.DataFrame(index=['c' + str(i) for i in range(180)],
+                                                               data={'day': [0.0] * 100 + [1.0] * 80}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            config = {'local_pca': 0, 'solver': 'nystrom', 'landmarks': 20, 'epsilon': 0.5}
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'dense'), **config).compute_transport_map(0.0, 1.0)
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'factors'), nystrom_factors=True, **config) \
+                .compute_transport_map(0.0, 1.0)
+            dense = wot.io.read_dataset(os.path.join(tmap_dir, 'dense_0.0_1.0.h5ad'))
+            factors = wot.io.read_dataset(os.path.join(tmap_dir, 'factors_0.0_1.0.h5ad'))
+            self.assertEqual(dense.uns['ot_low_rank'], 'densified')
+            self.assertEqual(factors.uns['ot_low_rank'], 'factors')
+            self.assertEqual(factors.X.nnz, 0)
+            self.assertGreaterEqual(np.min(dense.X), 0)
+            np.testing.assert_allclose(wot.ot.densify_transport_map(factors).X, dense.X)
+            tmap_model = wot.tmap.TransportMapModel({(0.0, 1.0): os.path.join(tmap_dir, 'factors_0.0_1.0.h5ad')},
+                                                    ds.obs[['day']])
+            np.testing.assert_allclose(tmap_model.get_transport_map(0.0, 1.0).X, dense.X)
+
+    def test_batch_solver(self):
+        # padded and stacked problems give the same transport maps as separate solves
+        np.random.seed(0)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 1000, 'tau': 10000, 'epsilon0': 1,
+                  'growth_iters': 2, 'inner_iter_max': 50}
+        cost_matrices = [wot.ot.OTModel.compute_default_cost_matrix(np.random.rand(n, 5), np.random.rand(m, 5))
+                         for n, m in [(30, 40), (25, 10), (40, 30)]]
+        gs = [np.random.rand(C.shape[0]) + 0.5 for C in cost_matrices]
+        tmaps = wot.ot.transport_stable_learn_growth_batch(cost_matrices, gs=gs, **config)
+        for C, g, tmap in zip(cost_matrices, gs, tmaps):
+            np.testing.assert_allclose(tmap, wot.ot.transport_stable_learn_growth(C, g=g, **config), rtol=1e-6,
+                                       atol=1e-10)
+
+        ds = anndata.AnnData(np.random.rand(80, 10), pd.DataFrame(index=['c' + str(i) for i in range(80)],
+                                                                  data={'day': [0.0, 1.0] * 40,
+                                                                        'covariate': [0, 0, 1, 1] * 20}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0).compute_all_transport_maps(
+                with_covariates=True)
+            tmap = wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_0.0_1.0_cv0_cv1.h5ad'))
+            self.assertEqual(tmap.shape, (20, 20))
+            self.assertIsNotNone(wot.ot.get_duals(tmap))
+        # with several threads, no day pair is left for the workers once all of them are batched
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, max_threads=2,
+                           max_memory=1).compute_all_transport_maps(with_covariates=True)
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_0.0_1.0_cv1_cv1.h5ad')))
+            # as in a shard without day pairs
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, max_threads=2,
+                           shard='1/2').compute_all_transport_maps()
+
+    def test_warm_started_growth_iterations(self):
+        # carrying the dual variables between growth iterations should not change the result
+        np.random.seed(0)
+        m1 = np.random.rand(30, 5)
+        m2 = np.random.rand(40, 5)
+        cost_matrix = wot.ot.OTModel.compute_default_cost_matrix(m1, m2)
+        config = {'lambda1': 1, 'lambda2': 50, 'epsilon': 0.05, 'scaling_iter': 1000, 'tau': 10000, 'epsilon0': 1}
+        row_sums = np.ones(m1.shape[0])
+        for i in range(3):
+            cold = wot.ot.transport_stablev2(cost_matrix, g=row_sums, pp=None, qq=None, numInnerItermax=50,
+                                             extra_iter=1000, **config)
+            row_sums = cold.sum(axis=1) / cold.shape[1]
+        warm, duals = wot.ot.transport_stable_learn_growth(cost_matrix, g=np.ones(m1.shape[0]), growth_iters=3,
+                                                           inner_iter_max=50, log=True, **config)
+        np.testing.assert_allclose(warm, cold, rtol=1e-6, atol=1e-10)
+        u, v = wot.ot.absorb_duals(duals)
+        np.testing.assert_allclose(np.exp((u[:, np.newaxis] + v - cost_matrix) / duals['epsilon']), warm,
+                                   rtol=1e-6, atol=1e-10)
+
+    def test_warm_start_from_stored_duals(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(60, 10),
+                             pd.DataFrame(index=['c' + str(i) for i in range(60)], data={'day': [0.0, 1.0] * 30}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            config = {'local_pca': 0, 'tolerance': 1e-7}
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), **config).compute_transport_map(0.0, 1.0)
+            tmap = wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_0.0_1.0.h5ad'))
+            duals = wot.ot.get_duals(tmap)
+            self.assertEqual(duals['epsilon'], 0.05)
+            self.assertEqual(len(duals['u']), 30)
+
+            config.update({'epsilon': 0.04, 'lambda2': 40})
+            cold = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'cold'), **config).compute_transport_map(0.0, 1.0)
+            warm = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), force=True, warm_start=True, **config) \
+                .compute_transport_map(0.0, 1.0)
+            np.testing.assert_allclose(warm.X, cold.X, rtol=1e-4, atol=1e-6 * cold.X.max())
+
+    def test_solver_trace(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(60, 10),
+                             pd.DataFrame(index=['c' + str(i) for i in range(60)], data={'day': [0.0, 1.0] * 30}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            model = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, scaling_iter=300,
+                                   growth_iters=2, trace_stride=100)
+            model.compute_all_transport_maps()
+            trace = wot.ot.get_solver_trace(wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_0.0_1.0.h5ad')))
+            # records every 100 iterations and at the last of the 300 + 1000 extra iterations
+            self.assertEqual(list(trace['iteration']), [100 * (i + 1) for i in range(13)] * 2)
+            self.assertEqual(list(trace['growth_iteration']), [0] * 13 + [1] * 13)
+            self.assertEqual(trace['epsilon'].iloc[-1], 0.05)
+            self.assertLess(trace['row_marginal_error'].iloc[-1], trace['row_marginal_error'].iloc[0])
+            summary = pd.read_csv(os.path.join(tmap_dir, 'tmaps_solver_summary.txt'), sep='\t')
+            self.assertEqual(summary['iterations'].tolist(), [2600])
+            pd.testing.assert_frame_equal(pd.read_json(os.path.join(tmap_dir, 'tmaps_0.0_1.0_trace.json')), trace,
+                                          check_dtype=False)
+
+    def test_extend_with_cells(self):
+        # a cell removed from a transport map gets back its row from the dual variables of the other cells
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(90, 10),
+                             pd.DataFrame(index=['c' + str(i) for i in range(90)], data={'day': [0.0, 1.0, 2.0] * 30}))
+        ds = ds[np.argsort(ds.obs['day'].values, kind='stable')].copy()
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            model = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, tolerance=1e-10)
+            full = {pair: model.compute_transport_map(*pair) for pair in [(0.0, 1.0), (1.0, 2.0)]}
+        tmaps = {(0.0, 1.0): full[(0.0, 1.0)][:, full[(0.0, 1.0)].var.index[:-1]].copy(),
+                 (1.0, 2.0): full[(1.0, 2.0)][full[(1.0, 2.0)].obs.index[:-1]].copy()}
+        tmap_model = wot.tmap.TransportMapModel(tmaps, ds.obs[['day']].drop('c88'))
+        self.assertEqual(list(tmap_model.extend_with_cells(ds, 1.0)), ['c88'])
+        self.assertEqual(list(tmap_model.meta.index), list(ds.obs.index))
+        for extended, expected in [(tmaps[(0.0, 1.0)].X[:, -1], full[(0.0, 1.0)].X[:, -1]),
+                                   (tmaps[(1.0, 2.0)].X[-1], full[(1.0, 2.0)].X[-1])]:
+            self.assertLess(np.abs(extended / extended.sum() - expected / expected.sum()).sum(), 0.01)
+
+        # transport maps read from disk are replaced atomically, and marked for recomputation in the manifest
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            paths = {}
+            for (t0, t1), tmap in tmaps.items():
+                paths[(t0, t1)] = os.path.join(tmap_dir, 'tmaps_{}_{}.h5ad'.format(t0, t1))
+                wot.ot.OTModel.write_transport_map(tmap[:, tmap.var.index[:-1]].copy() if t0 == 1.0 else tmap,
+                                                   paths[(t0, t1)], 'h5ad')
+            manifest_file = os.path.join(tmap_dir, 'tmaps_manifest.json')
+            wot.ot.OTModel.update_manifest_file(manifest_file, {'tmaps_0.0_1.0': 'a', 'tmaps_1.0_2.0': 'b'})
+            tmap_model = wot.tmap.TransportMapModel(paths, ds.obs[['day']].drop(['c88', 'c89']))
+            self.assertEqual(list(tmap_model.extend_with_cells(ds[ds.obs.index != 'c89'].copy(), 1.0)), ['c88'])
+            self.assertEqual(wot.io.read_dataset(paths[(0.0, 1.0)]).shape, (30, 30))
+            self.assertEqual(wot.io.read_dataset(paths[(1.0, 2.0)]).shape, (30, 29))
+            with open(manifest_file) as f:
+                self.assertEqual(json.load(f), {'tmaps_0.0_1.0': 'extended', 'tmaps_1.0_2.0': 'extended'})
+            self.assertEqual(sorted(os.listdir(tmap_dir)),
+                             ['tmaps_0.0_1.0.h5ad', 'tmaps_1.0_2.0.h5ad', 'tmaps_manifest.json'])
+
+        # with local PCA, new cells are projected on the basis stored with the transport map, read from disk
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            model = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=5, tolerance=1e-10)
+            model.compute_transport_map(0.0, 1.0)
+            tmap = wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_0.0_1.0.h5ad'))
+        geometry = wot.ot.get_cost_geometry(tmap)
+        self.assertEqual(geometry['x0'].shape, (30, 5))
+        p1 = ds[ds.obs['day'] == 1.0]
+        extended = wot.ot.extend_transport_map(tmap[:, tmap.var.index[:-1]].copy(), ds[ds.obs['day'] == 0.0], p1)
+        np.testing.assert_allclose(wot.ot.get_cost_geometry(extended)['x1'], geometry['x1'])
+        self.assertLess(np.abs(extended.X[:, -1] / extended.X[:, -1].sum()
+                               - tmap.X[:, -1] / tmap.X[:, -1].sum()).sum(), 0.01)
+        # transport maps without their cost geometry are not extended with another one
+        del tmap.uns['ot_cost_scale']
+        with self.assertRaises(ValueError):
+            wot.ot.extend_transport_map(tmap, ds[ds.obs['day'] == 0.0], p1)
+
+    def test_shared_matrix_workers(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(scipy.sparse.random(90, 10, density=0.5, format='csr', random_state=0),
+                             pd.DataFrame(index=['c' + str(i) for i in range(90)], data={'day': [0.0, 1.0, 2.0] * 30}))
+        with wot.ot.SharedMatrix(ds) as shared:
+            shared_ds = shared.open()
+            # read-only views of the memory-mapped files
+            self.assertFalse(shared_ds.X.data.flags.writeable)
+            np.testing.assert_array_equal(shared_ds.X.toarray(), ds.X.toarray())
+        self.assertFalse(os.path.exists(shared.directory))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, max_threads=2,
+                           global_pca=True).compute_all_transport_maps()
+            serial = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'serial'), local_pca=0, max_threads=1)
+            for t0, t1 in [(0.0, 1.0), (1.0, 2.0)]:
+                tmap = wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_{}_{}.h5ad'.format(t0, t1)))
+                np.testing.assert_allclose(tmap.X, serial.compute_transport_map(t0, t1).X)
+
+    def test_day_pair_scheduler(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(70, 10), pd.DataFrame(index=['c' + str(i) for i in range(70)],
+                                                                  data={'day': [0.0] * 10 + [1.0] * 40 + [2.0] * 20}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            model = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, max_threads=2,
+                                   max_memory=2 * 800 * 8 / 2 ** 30)
+            self.assertEqual(model.estimate_transport_map_cost(0.0, 1.0), (400 * 3 * 4000, 2 * 400 * 8))
+            self.assertEqual(model.estimate_transport_map_cost(1.0, 2.0), (800 * 3 * 4000, 2 * 800 * 8))
+            model.ot_config['precision'] = 'float32'
+            self.assertEqual(model.estimate_transport_map_cost(1.0, 2.0)[1], 2 * 800 * 4)
+            # both pairs fit in the budget in single precision
+            model.compute_all_transport_maps()
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_0.0_1.0.h5ad')))
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_1.0_2.0.h5ad')))
+
+    def test_blas_threads(self):
+        ds = anndata.AnnData(np.zeros((3110, 1)), pd.DataFrame(index=['c' + str(i) for i in range(3110)],
+                                                                data={'day': [0.0] * 2100 + [1.0] * 1000 + [2.0] * 10}))
+        model = wot.ot.OTModel(ds, None, local_pca=0, max_threads=4)
+        self.assertEqual(model.estimate_blas_threads(0.0, 1.0), 2)
+        self.assertEqual(model.estimate_blas_threads(1.0, 2.0), 1)
+        model.max_threads = 1
+        self.assertEqual(model.estimate_blas_threads(0.0, 1.0), 1)
+
+    def test_sharded_work_queue(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(80, 10), pd.DataFrame(index=['c' + str(i) for i in range(80)],
+                                                                  data={'day': [0.0, 1.0, 2.0, 3.0] * 20}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            # the first pair is claimed by another process, the second one is in shard 1/2
+            lock_file = os.path.join(tmap_dir, '.tmaps_0.0_1.0.h5ad.lock')
+            open(lock_file, 'w').close()
+            wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, work_queue=True, shard='1/2') \
+                .compute_all_transport_maps()
+            self.assertEqual(sorted(os.listdir(tmap_dir)),
+                             ['.tmaps_0.0_1.0.h5ad.lock', 'tmaps_1.0_2.0.h5ad', 'tmaps_manifest.json'])
+            os.remove(lock_file)
+
+            processes = [multiprocessing.Process(target=compute_all_transport_maps_in_queue,
+                                                 args=(ds, os.path.join(tmap_dir, 'tmaps'))) for _ in range(3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual([process.exitcode for process in processes], [0, 0, 0])
+            # no lock or temporary files are left
+            self.assertEqual(sorted(os.listdir(tmap_dir)),
+                             ['tmaps_0.0_1.0.h5ad', 'tmaps_1.0_2.0.h5ad', 'tmaps_2.0_3.0.h5ad',
+                              'tmaps_manifest.json'])
+            self.assertEqual(len(wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps')).read_manifest()), 3)
+        with self.assertRaises(ValueError):
+            wot.ot.OTModel(ds, None, shard='2/2')
+
+    def test_stale_locks(self):
+        process = multiprocessing.Process(target=int)
+        process.start()
+        process.join()
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            output_file = os.path.join(tmap_dir, 'tmaps_0.0_1.0.h5ad')
+            lock_file = os.path.join(tmap_dir, '.tmaps_0.0_1.0.h5ad.lock')
+            # the lock of a process that exited on this host is reclaimed
+            with open(lock_file, 'w') as f:
+                f.write('{} {} {}\n'.format(socket.gethostname(), process.pid, time.time()))
+            self.assertEqual(wot.ot.OTModel.claim_transport_map(output_file), lock_file)
+            with open(lock_file) as f:
+                self.assertEqual(int(f.read().split()[1]), os.getpid())
+            # locks of running processes and of other hosts are only reclaimed after the timeout
+            self.assertIsNone(wot.ot.OTModel.claim_transport_map(output_file))
+            with open(lock_file, 'w') as f:
+                f.write('other-host 1 {}\n'.format(time.time() - 100))
+            self.assertIsNone(wot.ot.OTModel.claim_transport_map(output_file))
+            self.assertIsNone(wot.ot.OTModel.claim_transport_map(output_file, timeout=1000))
+            self.assertEqual(wot.ot.OTModel.claim_transport_map(output_file, timeout=10), lock_file)
+
+            # shards summarize their own day pairs in separate files
+            np.random.seed(0)
+            ds = anndata.AnnData(np.random.rand(60, 10), pd.DataFrame(index=['c' + str(i) for i in range(60)],
+                                                                      data={'day': [0.0, 1.0, 2.0] * 20}))
+            for shard in ('0/2', '1/2'):
+                wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), local_pca=0, trace_stride=100, work_queue=True,
+                               shard=shard).compute_all_transport_maps()
+            self.assertFalse(os.path.exists(output_file))
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_1.0_2.0.h5ad')))
+            summary = pd.read_csv(os.path.join(tmap_dir, 'tmaps_shard1_solver_summary.txt'), sep='\t')
+            self.assertEqual(summary['t0'].tolist(), [1.0])
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_shard0_solver_summary.txt')))
+
+    def test_incremental_recompute(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(80, 10), pd.DataFrame(index=['c' + str(i) for i in range(80)],
+                                                                  data={'day': [0.0, 1.0, 2.0, 3.0] * 20}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            tmap_out = os.path.join(tmap_dir, 'tmaps')
+
+            def compute_all(ds, **kwargs):
+                # the inode of a transport map changes when it is written again
+                wot.ot.OTModel(ds, tmap_out, local_pca=0, **kwargs).compute_all_transport_maps()
+                return [os.stat(tmap_out + '_{}_{}.h5ad'.format(t, t + 1.0)).st_ino for t in (0.0, 1.0, 2.0)]
+
+            inodes = compute_all(ds)
+            self.assertEqual(compute_all(ds, trace_stride=10), inodes)
+            # changing the cells of day 2 only recomputes the transport maps from and to day 2
+            ds.X[ds.obs['day'] == 2.0] += 0.1
+            changed = compute_all(ds)
+            self.assertEqual(changed[0], inodes[0])
+            self.assertNotEqual(changed[1], inodes[1])
+            self.assertNotEqual(changed[2], inodes[2])
+            # as does changing the configuration
+            self.assertTrue(all(a != b for a, b in zip(compute_all(ds, epsilon=0.1), changed)))
+
+    def test_sweep(self):
+        np.random.seed(0)
+        ds = anndata.AnnData(np.random.rand(60, 10),
+                             pd.DataFrame(index=['c' + str(i) for i in range(60)], data={'day': [0.0, 1.0] * 30}))
+        with tempfile.TemporaryDirectory() as tmap_dir:
+            config = {'local_pca': 0, 'tolerance': 1e-7}
+            summary = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'tmaps'), **config) \
+                .sweep({'epsilon': [0.05, 0.1], 'lambda1': [1, 10]})
+            self.assertEqual(summary.shape[0], 4)
+            self.assertEqual(summary['epsilon'].iloc[0], 0.1)
+            self.assertTrue(os.path.exists(os.path.join(tmap_dir, 'tmaps_sweep_summary.txt')))
+
+            config.update({'epsilon': 0.05, 'lambda1': 10})
+            cold = wot.ot.OTModel(ds, os.path.join(tmap_dir, 'cold'), **config).compute_transport_map(0.0, 1.0)
+            swept = wot.io.read_dataset(os.path.join(tmap_dir, 'tmaps_epsilon-0.05_lambda1-10_0.0_1.0.h5ad'))
+            np.testing.assert_allclose(swept.X, cold.X, rtol=1e-4, atol=1e-6 * cold.X.max())
+
+        self.assertEqual(wot.ot.OTModel.get_sweep_order([{'epsilon': 0.1}, {'epsilon': 1}, {'epsilon': 0.5}]),
+                         [(1, None), (2, 1), (0, 2)])
+
     def test_growth_scores(self):
         scores = wot.ot.compute_growth_scores(np.array([-0.399883307]),
                                               np.array([0.006853961]))
@@ -6,6 +6,7 @@ from .gene_set_scores import *
 from .local_enrichment import *
 from .neighborhood_graph import *
 from .optimal_transport import *
+from .optimal_transport_sweep import *
 from .optimal_transport_validation import *
 from .trajectory import *
 from .trajectory_trends import *
@@ -14,6 +14,16 @@ def main(argv):
     wot.commands.add_ot_parameters_arguments(parser)
     parser.add_argument('--out', default='./tmaps',
                         help='Prefix for output file names')
+    parser.add_argument('--shard',
+                        help='Only compute the day pairs of shard i out of N, given as i/N with 0 <= i < N, '
+                             'to split the work between independent processes')
+    parser.add_argument('--work_queue', action='store_true',
+                        help='Claim each transport map with a lock file before computing it, so that processes '
+                             'writing to the same directory, on any node, never compute the same transport map')
+    parser.add_argument('--lock_timeout', type=float,
+                        help='With --work_queue, seconds after which the lock of a transport map held on another '
+                             'node is reclaimed. Locks of processes that are no longer running on the same node '
+                             'are always reclaimed')
     # parser.add_argument('--format', default='loom', help='Transport map file format.',
     #                     choices=wot.commands.FORMAT_CHOICES)
     args = parser.parse_args(argv)
@@ -25,6 +35,7 @@ def main(argv):
                                           lambda1=args.lambda1,
                                           lambda2=args.lambda2,
                                           max_threads=args.max_threads,
+                                          max_memory=args.max_memory,
                                           epsilon0=args.epsilon0,
                                           tau=args.tau,
                                           day_pairs=args.config,
@@ -36,7 +47,26 @@ def main(argv):
                                           sampling_bias=args.sampling_bias,
                                           scaling_iter=args.scaling_iter,
                                           inner_iter_max=args.inner_iter_max,
+                                          tolerance=args.tolerance,
+                                          trace_stride=args.trace_stride,
+                                          precision=args.precision,
+                                          solver=args.solver,
+                                          kernel_threshold=args.kernel_threshold,
+                                          knn=args.knn,
+                                          multiscale=args.multiscale,
+                                          multiscale_threshold=args.multiscale_threshold,
+                                          landmarks=args.landmarks,
+                                          nystrom_factors=args.nystrom_factors,
+                                          coreset=args.coreset,
+                                          median_sample_size=args.median_sample_size,
+                                          cost_matrix_dir=args.cost_matrix_dir,
+                                          cache_pca=args.cache_pca,
+                                          global_pca=args.global_pca,
                                           force=args.force,
+                                          warm_start=args.warm_start,
+                                          shard=args.shard,
+                                          work_queue=args.work_queue,
+                                          lock_timeout=args.lock_timeout,
                                           ncells=args.ncells,
                                           ncounts=args.ncounts,
                                           transpose=args.transpose
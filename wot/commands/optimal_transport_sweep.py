@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import wot.commands
+import wot.io
+import wot.ot
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Compute transport maps between pairs of time points for a grid of parameters')
+    wot.commands.add_model_arguments(parser)
+    wot.commands.add_ot_parameters_arguments(parser)
+    parser.add_argument('--epsilon_values', help='Comma separated values of epsilon to try. Defaults to --epsilon')
+    parser.add_argument('--lambda1_values', help='Comma separated values of lambda1 to try. Defaults to --lambda1')
+    parser.add_argument('--lambda2_values', help='Comma separated values of lambda2 to try. Defaults to --lambda2')
+    parser.add_argument('--out', default='./tmaps',
+                        help='Prefix for output file names')
+    args = parser.parse_args(argv)
+
+    param_grid = {}
+    for name, values, default in [('epsilon', args.epsilon_values, args.epsilon),
+                                  ('lambda1', args.lambda1_values, args.lambda1),
+                                  ('lambda2', args.lambda2_values, args.lambda2)]:
+        param_grid[name] = [float(value) for value in values.split(',')] if values is not None else [default]
+
+    ot_model = wot.ot.initialize_ot_model(args.matrix, args.cell_days,
+                                          tmap_out=args.out,
+                                          local_pca=args.local_pca,
+                                          growth_iters=args.growth_iters,
+                                          epsilon=args.epsilon,
+                                          lambda1=args.lambda1,
+                                          lambda2=args.lambda2,
+                                          max_threads=args.max_threads,
+                                          max_memory=args.max_memory,
+                                          epsilon0=args.epsilon0,
+                                          tau=args.tau,
+                                          day_pairs=args.config,
+                                          cell_day_filter=args.cell_day_filter,
+                                          cell_growth_rates=args.cell_growth_rates,
+                                          gene_filter=args.gene_filter,
+                                          cell_filter=args.cell_filter,
+                                          sampling_bias=args.sampling_bias,
+                                          scaling_iter=args.scaling_iter,
+                                          inner_iter_max=args.inner_iter_max,
+                                          tolerance=args.tolerance,
+                                          trace_stride=args.trace_stride,
+                                          precision=args.precision,
+                                          solver=args.solver,
+                                          kernel_threshold=args.kernel_threshold,
+                                          knn=args.knn,
+                                          multiscale=args.multiscale,
+                                          multiscale_threshold=args.multiscale_threshold,
+                                          landmarks=args.landmarks,
+                                          nystrom_factors=args.nystrom_factors,
+                                          coreset=args.coreset,
+                                          median_sample_size=args.median_sample_size,
+                                          cost_matrix_dir=args.cost_matrix_dir,
+                                          cache_pca=args.cache_pca,
+                                          global_pca=args.global_pca,
+                                          force=args.force,
+                                          ncells=args.ncells,
+                                          ncounts=args.ncounts,
+                                          transpose=args.transpose
+                                          )
+    ot_model.sweep(param_grid)
@@ -8,7 +8,6 @@ import anndata
 import itertools
 import numpy as np
 import pandas as pd
-import scipy.sparse
 
 import wot
 import wot.graphics
@@ -69,20 +68,14 @@ def compute_validation_summary(ot_model, day_pairs_triplets, save_interpolated=F
         p1_ds = ot_model.matrix[ot_model.matrix.obs['day'] == float(t1), :]
 
         if local_pca > 0:
-            matrices = list()
-            matrices.append(p0_ds.X if not scipy.sparse.isspmatrix(p0_ds.X) else p0_ds.X.toarray())
-            matrices.append(p1_ds.X if not scipy.sparse.isspmatrix(p1_ds.X) else p1_ds.X.toarray())
-            p0_pca, p1_pca, pca, mean_shift = wot.ot.compute_pca(p0_ds.X, p1_ds.X, local_pca)
+            p0_pca, p1_pca, pca, mean_shift = ot_model.embeddings.compute_pca(p0_ds, p1_ds, local_pca)
             p0_ds = anndata.AnnData(p0_pca, obs=p0_ds.obs,
                                     var=pd.DataFrame(index=pd.RangeIndex(start=0, stop=local_pca, step=1)))
             p1_ds = anndata.AnnData(p1_pca, obs=p1_ds.obs,
                                     var=pd.DataFrame(index=pd.RangeIndex(start=0, stop=local_pca, step=1)))
 
             eigenvals = np.diag(pca.singular_values_)
-            U = np.vstack(matrices).T.dot(pca.components_.T).dot(np.diag(1 / pca.singular_values_))
-            y = p05_ds.X - mean_shift
-
-            p05_ds = anndata.AnnData(np.diag(1 / pca.singular_values_).dot(U.T.dot(y.T)).T, obs=p05_ds.obs,
+            p05_ds = anndata.AnnData(wot.ot.project_on_pca(pca, mean_shift, p05_ds.X), obs=p05_ds.obs,
                                      var=pd.DataFrame(index=pd.RangeIndex(start=0, stop=local_pca, step=1)))
 
         if compute_full_distances:
@@ -197,6 +190,7 @@ def main(argv):
                                           lambda1=args.lambda1,
                                           lambda2=args.lambda2,
                                           max_threads=args.max_threads,
+                                          max_memory=args.max_memory,
                                           epsilon0=args.epsilon0,
                                           tau=args.tau,
                                           day_pairs=args.config,
@@ -207,7 +201,23 @@ def main(argv):
                                           sampling_bias=args.sampling_bias,
                                           scaling_iter=args.scaling_iter,
                                           inner_iter_max=args.inner_iter_max,
+                                          tolerance=args.tolerance,
+                                          trace_stride=args.trace_stride,
+                                          precision=args.precision,
+                                          solver=args.solver,
+                                          kernel_threshold=args.kernel_threshold,
+                                          knn=args.knn,
+                                          multiscale=args.multiscale,
+                                          multiscale_threshold=args.multiscale_threshold,
+                                          landmarks=args.landmarks,
+                                          nystrom_factors=args.nystrom_factors,
+                                          coreset=args.coreset,
+                                          median_sample_size=args.median_sample_size,
+                                          cost_matrix_dir=args.cost_matrix_dir,
+                                          cache_pca=args.cache_pca,
+                                          global_pca=args.global_pca,
                                           force=args.force,
+                                          warm_start=args.warm_start,
                                           ncells=args.ncells,
                                           ncounts=args.ncounts,
                                           covariate=args.covariate,
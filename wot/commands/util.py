@@ -54,17 +54,75 @@ def add_ot_parameters_arguments(parser):
                              'fidelity of the constraints on q')
     parser.add_argument('--max_threads', type=int, default=1,
                         help='Maximal number of threads to use when parallelizing tmap computation')
+    parser.add_argument('--max_memory', type=float,
+                        help='Memory budget in gigabytes for the transport maps computed at once. Transport maps '
+                             'are computed largest first, and only as many at once as fit in the budget. '
+                             'Use with --max_threads 0 to use as many cores as the budget allows')
     parser.add_argument('--epsilon0', type=float, default=1,
                         help='Warm starting value for epsilon')
     parser.add_argument('--tau', type=float, default=10000)
+    parser.add_argument('--tolerance', type=float,
+                        help='Stop the OT solver early once the marginal violation and the relative change in the '
+                             'dual variables are below this threshold. By default, all scaling iterations are performed')
+    parser.add_argument('--trace_stride', type=int,
+                        help='Record the marginal errors, epsilon and stabilizations of the OT solver every '
+                             'trace_stride scaling iterations. Traces are saved with each transport map and in a '
+                             'JSON file next to it, and summarized in {out}_solver_summary.txt')
+    parser.add_argument('--solver', default='stable', choices=['stable', 'accelerated', 'log', 'sparse', 'nystrom'],
+                        help='OT solver. "accelerated" over-relaxes the scaling iterations to converge in fewer '
+                             'iterations, use it with --tolerance. '
+                             '"log" works in the log domain and never builds the full kernel matrix, '
+                             'using less memory at the expense of speed. "sparse" only keeps the largest '
+                             'kernel entries and produces sparse transport maps. "nystrom" approximates the kernel '
+                             'from its values at a few landmark cells and never builds the cost matrix, '
+                             'only use it with larger values of epsilon, such as 0.5')
+    parser.add_argument('--landmarks', type=int,
+                        help='Number of landmark cells of the nystrom solver. Default is 200')
+    parser.add_argument('--nystrom_factors', action='store_true',
+                        help='Only save the low-rank factors of the transport maps of the nystrom solver, '
+                             'instead of the dense transport maps, with negative entries clamped to zero')
+    parser.add_argument('--kernel_threshold', type=float,
+                        help='With the sparse solver, drop kernel entries below this value, none with 0. '
+                             'Default is 1e-8. The full cost matrix is still computed first, use --knn to avoid it')
+    parser.add_argument('--knn', type=int,
+                        help='With the sparse solver, only consider the cost between each cell and its knn nearest '
+                             'neighbors at the other timepoint, without computing the full cost matrix')
+    parser.add_argument('--multiscale', type=int,
+                        help='Group the cells of each timepoint into this many clusters, compute the transport map '
+                             'between clusters, then only consider the cost between cells of clusters exchanging '
+                             'mass. Recommended above 50,000 cells per timepoint')
+    parser.add_argument('--multiscale_threshold', type=float,
+                        help='With --multiscale, keep the pairs of clusters transporting at least this fraction of '
+                             'the mass of either cluster. Default is 1e-3')
+    parser.add_argument('--coreset', type=int,
+                        help='Replace the cells of each timepoint by this many weighted representatives, the centers '
+                             'of k-means clusters in local PCA space, and give each cell the transport map of its '
+                             'representative')
+    parser.add_argument('--median_sample_size', type=int,
+                        help='Normalize the cost matrix by the median cost of this many random pairs of cells, such as '
+                             '100000, instead of the exact median over all pairs')
+    parser.add_argument('--cost_matrix_dir',
+                        help='Build the default cost matrices in temporary memory-mapped files in this directory, '
+                             'to keep them out of memory. Best combined with --median_sample_size')
+    parser.add_argument('--cache_pca', action='store_true',
+                        help='Save the local PCA of each day pair next to the transport maps and reuse it in later '
+                             'runs on the same cells and genes')
+    parser.add_argument('--global_pca', action='store_true',
+                        help='Use a single PCA of all cells instead of a local PCA for each day pair')
+    parser.add_argument('--precision', default='float64', choices=['float64', 'float32'],
+                        help='Floating point precision of the cost matrix and OT solver. '
+                             'float32 halves memory usage')
     parser.add_argument('--ncells', type=int, help='Number of cells to downsample from each timepoint and covariate')
     parser.add_argument('--ncounts', help='Sample ncounts from each cell', type=int)
-    parser.add_argument('--force', help='Overwrite existing transport maps if they exist', action='store_true')
+    parser.add_argument('--force', action='store_true',
+                        help='Overwrite existing transport maps, even if their cells, genes and parameters did not '
+                             'change since they were computed')
+    parser.add_argument('--warm_start', action='store_true',
+                        help='Initialize the OT solver from the dual variables stored with existing transport maps. '
+                             'Use with --force to quickly recompute them after changing parameters')
     parser.add_argument('--sampling_bias', help='File with "id" and "pp" to correct sampling bias.')
 
     # parser.add_argument('--max_iter', type=int, default=1e7,
     #                     help='Maximum number of scaling iterations. Abort if convergence was not reached')
     # parser.add_argument('--batch_size', type=int, default=50,
     #                     help='Number of scaling iterations to perform between duality gap check')
-    # parser.add_argument('--tolerance', type=int, default=1e-2,
-    #                     help='Maximal acceptable ratio between the duality gap and the primal objective value')
@@ -4,3 +4,5 @@ from .optimal_transport_helper import *
 from .util import *
 from .initializer import *
 from .ot_model import *
+from .embedding_cache import *
+from .shared_matrix import *
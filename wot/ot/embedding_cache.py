@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse
+
+import wot.io
+import wot.ot
+
+
+class EmbeddingCache:
+    """
+    Caches the local PCA coordinates of pairs of timepoints, in memory and optionally on disk.
+
+    Embeddings are identified by the ids of the cells and genes, the expression values and the number
+    of components, so that any change in the input or in the gene filter computes them again.
+    The expression values of each set of cells and genes are only hashed once, by the first lookup,
+    so they must not be modified in place while the cache is in use.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory the embeddings are saved to, such as the transport map directory. None to only keep them in memory
+    prefix : str, optional
+        Prefix of the embedding files, {prefix}_pca_{t0}_{t1}_{n_components}_{fingerprint}.npz
+    matrix : anndata.AnnData, optional
+        Compute a single global PCA of all the cells of this matrix, and restrict it to each pair of timepoints
+        instead of computing a local PCA for each pair
+    """
+
+    def __init__(self, directory=None, prefix='tmaps', matrix=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.matrix = matrix
+        self.embeddings = {}
+        self.fingerprints = {}
+
+    @staticmethod
+    def fingerprint(key, *datasets, obs_columns=()):
+        """
+        Computes a hash of key and of the cell ids, gene ids and expression values of datasets,
+        and of their obs_columns when present.
+        """
+        h = hashlib.sha1(str(key).encode())
+        for ds in datasets:
+            h.update('\t'.join(ds.obs.index.astype(str)).encode())
+            h.update('\t'.join(ds.var.index.astype(str)).encode())
+            x = ds.X
+            if scipy.sparse.issparse(x):
+                x = x.tocsr()
+                for array in (x.data, x.indices, x.indptr):
+                    h.update(np.ascontiguousarray(array).tobytes())
+            else:
+                h.update(np.ascontiguousarray(x).tobytes())
+            for column in obs_columns:
+                if column in ds.obs.columns:
+                    h.update(column.encode())
+                    h.update(np.ascontiguousarray(ds.obs[column].values, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def get_fingerprint(self, ds):
+        """
+        Computes the fingerprint of a dataset, or retrieves it if its cells and genes were already hashed.
+        """
+        ids = hashlib.sha1('\t'.join(ds.obs.index.astype(str)).encode())
+        ids.update('\n'.join(ds.var.index.astype(str)).encode())
+        ids = ids.hexdigest()
+        fingerprint = self.fingerprints.get(ids)
+        if fingerprint is None:
+            fingerprint = EmbeddingCache.fingerprint('', ds)
+            self.fingerprints[ids] = fingerprint
+        return fingerprint
+
+    def compute_pca(self, p0, p1, n_components):
+        """
+        Computes or retrieves the local PCA coordinates of two sets of cells.
+
+        Parameters
+        ----------
+        p0 : anndata.AnnData
+            The source cells
+        p1 : anndata.AnnData
+            The destination cells
+        n_components : int
+            Number of components
+
+        Returns
+        -------
+        The same coordinates, PCA and mean as wot.ot.compute_pca(p0.X, p1.X, n_components).
+        With a global PCA, the coordinates of p0 and p1 in the PCA of all cells.
+        """
+        if self.matrix is not None:
+            x, pca, mean_shift = self.get_global_pca(n_components)
+            index = self.matrix.obs.index
+            return x[index.get_indexer(p0.obs.index)], x[index.get_indexer(p1.obs.index)], pca, mean_shift
+        days = [ds.obs['day'].iloc[0] if 'day' in ds.obs.columns and ds.shape[0] > 0 else 'na' for ds in (p0, p1)]
+        name = '{}_pca_{}_{}_{}'.format(self.prefix, *days, n_components)
+        x, pca, mean_shift = self.get(name, n_components, [p0, p1],
+                                      lambda: wot.ot.compute_pca(p0.X, p1.X, n_components))
+        return x[:p0.shape[0]], x[p0.shape[0]:], pca, mean_shift
+
+    def get_global_pca(self, n_components):
+        """
+        Computes or retrieves the global PCA of all the cells of the matrix.
+
+        Returns
+        -------
+        x : 2-D array
+            The coordinates of every cell, in the order of the matrix
+        pca : wot.ot.TruncatedPCA
+            The PCA
+        mean_shift : 1-D array
+            The mean of each gene
+        """
+        name = '{}_pca_global_{}'.format(self.prefix, n_components)
+        return self.get(name, n_components, [self.matrix],
+                        lambda: wot.ot.compute_pca(self.matrix.X, self.matrix.X[:0], n_components))
+
+    def get(self, name, n_components, datasets, compute):
+        """
+        Retrieves an embedding of datasets from memory or disk, or computes and saves it with compute().
+        """
+        key = hashlib.sha1(str(n_components).encode())
+        for ds in datasets:
+            key.update(self.get_fingerprint(ds).encode())
+        key = name + '_' + key.hexdigest()[:16]
+        embedding = self.embeddings.get(key)
+        path = os.path.join(self.directory, key + '.npz') if self.directory is not None else None
+        if embedding is None and path is not None and os.path.exists(path):
+            wot.io.verbose('Loading cached PCA from ' + path)
+            with np.load(path) as f:
+                pca = wot.ot.TruncatedPCA(f['components'], f['singular_values'], f['mean'], f['gene_components'])
+                embedding = f['x'], pca, f['mean_shift']
+        if embedding is None:
+            x0, x1, pca, mean_shift = compute()
+            embedding = np.vstack((x0, x1)), pca, mean_shift
+            if path is not None:
+                # Write to a temporary file first, other processes may be reading the cache
+                tmp_path = path + '.{}.tmp.npz'.format(os.getpid())
+                np.savez(tmp_path, x=embedding[0], components=pca.components_, singular_values=pca.singular_values_,
+                         mean=pca.mean_, gene_components=pca.gene_components_, mean_shift=mean_shift)
+                os.replace(tmp_path, path)
+        self.embeddings[key] = embedding
+        return embedding
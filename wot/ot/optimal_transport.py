@@ -11,7 +11,9 @@ import wot
 
 
 def transport_stable_learn_growth(C, lambda1, lambda2, epsilon, scaling_iter, g, pp=None, qq=None, tau=None,
-                                  epsilon0=None, growth_iters=3, inner_iter_max=None):
+                                  epsilon0=None, growth_iters=3, inner_iter_max=None, tolerance=None, batch_size=50,
+                                  precision='float64', solver='stable', kernel_threshold=None, duals=None, log=False,
+                                  **kwargs):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
@@ -22,17 +24,73 @@ def transport_stable_learn_growth(C, lambda1, lambda2, epsilon, scaling_iter, g,
         epsilon: entropy parameter
         scaling_iter: number of scaling iterations
         g: growth value for input cells
+        tolerance: convergence threshold for early stopping. None to always perform all scaling iterations
+        batch_size: number of scaling iterations between each convergence check
+        precision: floating point type used by the solver, 'float64' or 'float32'
+        solver: 'stable' for transport_stablev2, 'accelerated' for transport_stablev2 with over-relaxation,
+            'log' for the log-domain transport_stable_log,
+            or 'sparse' for transport_stablev2 on a truncated sparse kernel. In that case, C may already be
+            a sparse matrix holding the costs of the pairs to keep, otherwise see sparsify_cost_matrix.
+            'nystrom' for transport_stablev2 on a low-rank approximation of the kernel, C must be a LandmarkCost
+            and the transport map is returned as a LowRankMatrix
+        kernel_threshold: for the sparse solver, kernel entries below this value are dropped. Defaults to 1e-8.
+            It applies to a dense C, that was already computed in full, unlike a sparse nearest neighbors cost matrix
+        duals: initial dual variables for the first growth iteration, as returned with log=True
+        log: also return the final dual variables, with the total number of scaling iterations as n_iter.
+            With trace_stride, the traces of all growth iterations are concatenated in trace, see transport_stablev2
+        **kwargs: additional options for the selected solver
+
+    Notes:
+        The dual variables of each growth iteration are used to initialize the next one, which starts directly
+        at the final epsilon. When a tolerance is given, growth iterations also stop as soon as the relative
+        change in the learned row sums is below it. When the solver is given output cell weights dy,
+        the learned growth is Tmap.dot(dy).
     """
+    if solver == 'stable':
+        transport = transport_stablev2
+    elif solver == 'accelerated':
+        transport = transport_stablev2
+        kwargs['over_relaxation'] = True
+    elif solver == 'log':
+        transport = transport_stable_log
+    elif solver == 'sparse':
+        transport = transport_stablev2
+        if not scipy.sparse.issparse(C):
+            C = sparsify_cost_matrix(C, epsilon, kernel_threshold if kernel_threshold is not None else 1e-8)
+    elif solver == 'nystrom':
+        transport = transport_stablev2
+        if not isinstance(C, LandmarkCost):
+            raise ValueError('The nystrom solver requires a LandmarkCost')
+    else:
+        raise ValueError('Unknown solver: ' + solver)
+
+    n_iter = 0
+    trace = []
     for i in range(growth_iters):
         if i == 0:
             rowSums = g
         else:
-            rowSums = Tmap.sum(axis=1) / Tmap.shape[1]
-
-        Tmap = transport_stablev2(C=C, lambda1=lambda1, lambda2=lambda2, epsilon=epsilon,
-                                  scaling_iter=scaling_iter, g=rowSums, tau=tau,
-                                  epsilon0=epsilon0, pp=pp, qq=qq, numInnerItermax=inner_iter_max,
-                                  extra_iter=1000)
+            previousRowSums = rowSums
+            if kwargs.get('dy') is None:
+                rowSums = np.asarray(Tmap.sum(axis=1)).ravel() / Tmap.shape[1]
+            else:
+                rowSums = np.asarray(Tmap.dot(kwargs['dy'])).ravel()
+            if tolerance is not None and \
+                    np.linalg.norm(rowSums - previousRowSums) <= tolerance * np.linalg.norm(previousRowSums):
+                break
+
+        Tmap, duals = transport(C=C, lambda1=lambda1, lambda2=lambda2, epsilon=epsilon,
+                                scaling_iter=scaling_iter, g=rowSums, tau=tau,
+                                epsilon0=epsilon0, pp=pp, qq=qq, numInnerItermax=inner_iter_max,
+                                extra_iter=1000, tolerance=tolerance, batch_size=batch_size,
+                                precision=precision, duals=duals, log=True, **kwargs)
+        n_iter += duals['n_iter']
+        trace += [{'growth_iteration': i, **record} for record in duals.pop('trace', [])]
+    if log:
+        duals['n_iter'] = n_iter
+        if kwargs.get('trace_stride') is not None:
+            duals['trace'] = trace
+        return Tmap, duals
     return Tmap
 
 
@@ -109,7 +167,7 @@ def dual(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
 # end @ Lénaïc Chizat
 
 def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tolerance, tau=10e100, epsilon0=1.,
-                       max_iter=1e7):
+                       max_iter=1e7, precision='float64'):
     """
     Compute the optimal transport with stabilized numerics, with the guarantee that the duality gap is at most `tolerance`
 
@@ -135,19 +193,23 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
         Starting value for exponentially-decreasing epsilon
     max_iter : int, optional
         Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    precision : str, optional
+        Floating point type used for all computations, 'float64' or 'float32'.
+        Single precision halves memory usage and bandwidth of the matrix-vector products.
 
     Returns
     -------
     transport_map : 2-D ndarray
         The entropy-regularized unbalanced transport map
     """
-    C = np.asarray(C, dtype=np.float64)
+    dtype = np.dtype(precision)
+    C = np.asarray(C, dtype=dtype)
     epsilon_scalings = 5
-    scale_factor = np.exp(- np.log(epsilon) / epsilon_scalings)
+    scale_factor = float(np.exp(- np.log(epsilon) / epsilon_scalings))
 
     I, J = C.shape
-    dx, dy = np.ones(I) / I, np.ones(J) / J
-    p = g
+    dx, dy = np.ones(I, dtype=dtype) / I, np.ones(J, dtype=dtype) / J
+    p = np.asarray(g, dtype=dtype)
     if pp is not None:
         pp = pp / np.average(pp)
         p *= pp
@@ -157,8 +219,9 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
         q = qq * np.sum(g * pp) / I
     else:
         q = np.ones(J) * np.average(g)
-    u, v = np.zeros(I), np.zeros(J)
-    a, b = np.ones(I), np.ones(J)
+    q = np.asarray(q, dtype=dtype)
+    u, v = np.zeros(I, dtype=dtype), np.zeros(J, dtype=dtype)
+    a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
 
     start_time = time.time()
     duality_time = 0
@@ -174,7 +237,7 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
         alpha1 = lambda1 / (lambda1 + epsilon_i)
         alpha2 = lambda2 / (lambda2 + epsilon_i)
         K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-        a, b = np.ones(I), np.ones(J)
+        a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
         old_a, old_b = a, b
         threshold = tolerance if e == epsilon_scalings else 1e-6
 
@@ -191,7 +254,7 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
                     u = u + epsilon_i * np.log(a)
                     v = v + epsilon_i * np.log(b)  # absorb
                     K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-                    a, b = np.ones(I), np.ones(J)
+                    a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
 
                 if current_iter >= max_iter:
                     print("Warning : Reached max_iter with duality gap still above threshold. Returning")
@@ -224,28 +287,63 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
 
 
 def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, numInnerItermax, tau,
-                       epsilon0, extra_iter):
+                       epsilon0, extra_iter, tolerance=None, batch_size=50, precision='float64', duals=None, log=False,
+                       over_relaxation=False, dx=None, dy=None, trace_stride=None):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
 
-        C: cost matrix to transport cell i to cell j
+        C: cost matrix to transport cell i to cell j. If C is a scipy sparse matrix, only its stored
+            entries are considered as possible pairs, and the resulting transport map is a CSR matrix.
+            If C is a LandmarkCost, the kernel is approximated by a low-rank matrix, each scaling
+            iteration costs O((n + m) * landmarks) and the resulting transport map is a LowRankMatrix
         lambda1: regularization parameter for marginal constraint for p.
         lambda2: regularization parameter for marginal constraint for q.
         epsilon: entropy parameter
         scaling_iter: number of scaling iterations
         g: growth value for input cells
+        tolerance: stop as soon as both the marginal violation and the relative change in the dual
+            variables are below this value. None to always perform scaling_iter + extra_iter iterations
+        batch_size: number of scaling iterations between each convergence check
+        precision: floating point type used for the cost matrix, the kernel and the scaling vectors,
+            'float64' or 'float32'. Absorbing the scaling vectors into the kernel every time they
+            exceed tau keeps single precision safe from overflow.
+        duals: dict of initial dual variables 'u', 'v', 'a', 'b' and 'epsilon', as returned with log=True.
+            When given, the solver starts directly at the final epsilon
+        log: also return a dict with the final dual variables. The absorbed dual variables are u and v,
+            the scaling vectors a and b, so that the transport map is exp((u_i + v_j - C_ij) / epsilon) * a_i * b_j.
+            The number of scaling iterations performed is stored as n_iter
+        over_relaxation: extrapolate each scaling update in the log domain, a = a^(1 - omega) * a_sinkhorn^omega.
+            omega is adapted to the estimated convergence rate of the plain iterations, see relaxation_factor
+        dx: weight of each input cell, 1 / C.shape[0] by default. Used to solve problems between weighted
+            groups of cells, see OTModel.compute_multiscale_cost_matrix
+        dy: weight of each output cell, 1 / C.shape[1] by default
+        trace_stride: with log=True, also return as trace a list with one record every trace_stride scaling
+            iterations and at the last one: the iteration, epsilon, the relative marginal errors, the number of
+            stabilizations so far and the elapsed time. Each record costs two extra kernel products
+
+    Notes:
+        Convergence is only checked once epsilon has reached its final value. When a tolerance is
+        given, the exponentially-decreasing epsilon is snapped to its final value as soon as it is
+        within that relative tolerance of it.
     """
 
     warm_start = tau is not None
     epsilon_final = epsilon
 
     def get_reg(n):  # exponential decreasing
-        return (epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final
+        return float((epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final)
 
     epsilon_i = epsilon0 if warm_start else epsilon
-    dx = np.ones(C.shape[0]) / C.shape[0]
-    dy = np.ones(C.shape[1]) / C.shape[1]
+    dtype = np.dtype(precision)
+    if scipy.sparse.issparse(C):
+        C = C.tocsr().astype(dtype)
+    elif isinstance(C, LandmarkCost):
+        C = C.astype(dtype)
+    else:
+        C = np.asarray(C, dtype=dtype)
+    dx = np.ones(C.shape[0], dtype=dtype) / C.shape[0] if dx is None else np.asarray(dx, dtype=dtype)
+    dy = np.ones(C.shape[1], dtype=dtype) / C.shape[1] if dy is None else np.asarray(dy, dtype=dtype)
 
     # if pp is not None:
     #     pp = pp / np.average(pp)
@@ -257,50 +355,879 @@ def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, nu
 
     # p = g / np.average(g, weights=dx)
     # q = np.ones(C.shape[1])
-    p = g
-    q = np.ones(C.shape[1]) * np.average(g)
-
-    u = np.zeros(len(p))
-    v = np.zeros(len(q))
-    b = np.ones(len(q))
-    K = np.exp(-C / epsilon_i)
+    p = np.asarray(g, dtype=dtype)
+    q = np.full(C.shape[1], np.average(g), dtype=dtype)
+
+    u = np.zeros(len(p), dtype=dtype)
+    v = np.zeros(len(q), dtype=dtype)
+    a = np.ones(len(p), dtype=dtype)
+    b = np.ones(len(q), dtype=dtype)
+    if duals is not None:
+        u, v = absorb_duals(duals, dtype)
+        epsilon_i = epsilon
+    K = stabilized_kernel(C, u, v, epsilon_i)
+    # Dense kernels are updated in place when u, v or epsilon change
+    out = K if isinstance(K, np.ndarray) else None
 
     alpha1 = lambda1 / (lambda1 + epsilon_i)
     alpha2 = lambda2 / (lambda2 + epsilon_i)
     epsilon_index = 0
     iterations_since_epsilon_adjusted = 0
+    previous_duals = None
+
+    def converged(a, b):
+        # Only compare dual variables computed with the final epsilon
+        nonlocal previous_duals
+        if epsilon_i != epsilon_final:
+            previous_duals = None
+            return False
+        # The real dual variables. a and b are only the stabilized variables
+        _u = u + epsilon_i * np.log(a)
+        _v = v + epsilon_i * np.log(b)
+        # At the fixed point, the row marginal is p * exp(-_u / lambda1)
+        row_marginal = a * K.dot(np.multiply(b, dy))
+        target = p * np.exp(-_u / lambda1)
+        marginal_error = np.sum(np.abs(row_marginal - target)) / np.sum(target)
+        if previous_duals is None:
+            dual_change = np.inf
+        else:
+            dual_change = max(np.linalg.norm(_u - previous_duals[0]) / (1 + np.linalg.norm(_u)),
+                              np.linalg.norm(_v - previous_duals[1]) / (1 + np.linalg.norm(_v)))
+        previous_duals = (_u, _v)
+        return marginal_error < tolerance and dual_change < tolerance
 
+    start_time = time.time()
+    trace = []
+    stabilizations = 0
+
+    def record(a, b):
+        # Relative L1 distances of the marginals to their values at the fixed point
+        row_marginal = a * K.dot(np.multiply(b, dy))
+        column_marginal = b * K.T.dot(np.multiply(a, dx))
+        row_target = p * np.exp(-(u + epsilon_i * np.log(a)) / lambda1)
+        column_target = q * np.exp(-(v + epsilon_i * np.log(b)) / lambda2)
+        trace.append({'iteration': n_iter, 'epsilon': epsilon_i,
+                      'row_marginal_error': float(np.sum(np.abs(row_marginal - row_target)) / np.sum(row_target)),
+                      'column_marginal_error': float(np.sum(np.abs(column_marginal - column_target))
+                                                     / np.sum(column_target)),
+                      'stabilizations': stabilizations, 'time': time.time() - start_time})
+
+    # Buffers reused by every scaling iteration
+    weighted_b = np.empty(len(q), dtype=dtype)
+    weighted_a = np.empty(len(p), dtype=dtype)
+    row_sums = np.empty(len(p), dtype=dtype)
+    column_sums = np.empty(len(q), dtype=dtype)
+
+    def scaling_factors():
+        # p^alpha1 * exp(-u / (lambda1 + epsilon)) only changes with u and epsilon
+        return p ** alpha1 * np.exp(-u / (lambda1 + epsilon_i)), q ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+
+    def scaling_step(a, b):
+        # a = (p / K (b dy))^alpha1 * exp(-u / (lambda1 + epsilon)), then b likewise, in place.
+        # Returns the largest scaling value
+        np.multiply(b, dy, out=weighted_b)
+        matvec(K, weighted_b, row_sums)
+        largest = update_scaling(row_sums, factor_a, alpha1, a)
+        np.multiply(a, dx, out=weighted_a)
+        matvec(K.T, weighted_a, column_sums)
+        return max(largest, update_scaling(column_sums, factor_b, alpha2, b))
+
+    omega = 1.0
+    max_omega = MAX_RELAXATION
+    residuals = []
+    a_hat = np.empty(len(p), dtype=dtype)
+    b_hat = np.empty(len(q), dtype=dtype)
+
+    def relaxed_step(a, b):
+        # Sinkhorn step, extrapolated by omega once the plain convergence rate has been estimated
+        nonlocal omega, max_omega
+        np.multiply(b, dy, out=weighted_b)
+        matvec(K, weighted_b, row_sums)
+        update_scaling(row_sums, factor_a, alpha1, a_hat)
+        residuals.append(np.max(np.abs(np.log(a_hat) - np.log(a))))
+        if len(residuals) > RELAXATION_WINDOW:
+            if omega == 1:
+                omega = min(relaxation_factor(residuals[0], residuals[-1], RELAXATION_WINDOW), max_omega)
+                # Relaxed updates are larger than plain ones and grow at first, only compare them
+                # with each other from the next window on
+                del residuals[:]
+            elif len(residuals) > 2 * RELAXATION_WINDOW and residuals[-1] > residuals[RELAXATION_WINDOW]:
+                # No progress over the window, estimate the rate again and extrapolate less
+                max_omega = 1 + RELAXATION_BACKOFF * (omega - 1)
+                omega = 1.0
+                del residuals[:]
+            elif len(residuals) > 2 * RELAXATION_WINDOW:
+                del residuals[:RELAXATION_WINDOW]
+        extrapolate(a, a_hat, omega)
+        np.multiply(a, dx, out=weighted_a)
+        matvec(K.T, weighted_a, column_sums)
+        update_scaling(column_sums, factor_b, alpha2, b_hat)
+        extrapolate(b, b_hat, omega)
+        return max(a.max(), b.max())
+
+    step = relaxed_step if over_relaxation else scaling_step
+    factor_a, factor_b = scaling_factors()
+    done = False
+    n_iter = 0
     for i in range(scaling_iter):
         # scaling iteration
-        a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
-        b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+        n_iter += 1
+        largest = step(a, b)
 
         # stabilization
         iterations_since_epsilon_adjusted += 1
-        if (max(max(abs(a)), max(abs(b))) > tau):
+        if largest > tau:
             u = u + epsilon_i * np.log(a)
             v = v + epsilon_i * np.log(b)  # absorb
-            K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-            a = np.ones(len(p))
-            b = np.ones(len(q))
+            K = stabilized_kernel(C, u, v, epsilon_i, out=out)
+            factor_a, factor_b = scaling_factors()
+            a.fill(1)
+            b.fill(1)
+            stabilizations += 1
 
-        if (warm_start and iterations_since_epsilon_adjusted == numInnerItermax):
+        if (warm_start and epsilon_i != epsilon_final and iterations_since_epsilon_adjusted == numInnerItermax):
             epsilon_index += 1
             iterations_since_epsilon_adjusted = 0
             u = u + epsilon_i * np.log(a)
             v = v + epsilon_i * np.log(b)  # absorb
             epsilon_i = get_reg(epsilon_index)
+            if tolerance is not None and epsilon_i - epsilon_final <= tolerance * epsilon_final:
+                epsilon_i = epsilon_final
             alpha1 = lambda1 / (lambda1 + epsilon_i)
             alpha2 = lambda2 / (lambda2 + epsilon_i)
-            K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-            a = np.ones(len(p))
-            b = np.ones(len(q))
+            K = stabilized_kernel(C, u, v, epsilon_i, out=out)
+            factor_a, factor_b = scaling_factors()
+            a.fill(1)
+            b.fill(1)
+            # The convergence rate depends on epsilon
+            omega = 1.0
+            max_omega = MAX_RELAXATION
+            residuals.clear()
+
+        if trace_stride is not None and n_iter % trace_stride == 0:
+            record(a, b)
+        if tolerance is not None and (i + 1) % batch_size == 0 and converged(a, b):
+            done = True
+            break
 
-    for i in range(extra_iter):
-        a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
-        b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+    if not done:
+        for i in range(extra_iter):
+            n_iter += 1
+            step(a, b)
+            if trace_stride is not None and n_iter % trace_stride == 0:
+                record(a, b)
+            if tolerance is not None and (i + 1) % batch_size == 0 and converged(a, b):
+                break
+
+    if trace_stride is not None and (len(trace) == 0 or trace[-1]['iteration'] != n_iter):
+        record(a, b)
+
+    if scipy.sparse.issparse(K):
+        tmap = scipy.sparse.diags(a).dot(K).dot(scipy.sparse.diags(b)).tocsr()
+    elif isinstance(K, LowRankMatrix):
+        tmap = K.scale(a, b)
+    else:
+        # The kernel is not needed anymore
+        tmap = K
+        tmap *= a[:, np.newaxis]
+        tmap *= b
+    if log:
+        duals = {'u': u, 'v': v, 'a': a, 'b': b, 'epsilon': epsilon_i, 'n_iter': n_iter}
+        if trace_stride is not None:
+            duals['trace'] = trace
+        return tmap, duals
+    return tmap
 
-    return (K.T * a).T * b
+
+def transport_stable_learn_growth_batch(Cs, lambda1, lambda2, epsilon, scaling_iter, gs, tau=None, epsilon0=None,
+                                        growth_iters=3, inner_iter_max=None, tolerance=None, batch_size=50,
+                                        precision='float64', duals=None, log=False, **kwargs):
+    """
+    Compute several optimal transports with the same parameters at once, learning the growth of each.
+    Args:
+
+        Cs: list of cost matrices, each one for a separate problem
+        gs: list of growth values for the input cells of each problem
+        duals: list of initial dual variables for each problem, as returned with log=True
+        log: also return the list of final dual variables
+
+    Notes:
+        See transport_stable_learn_growth for the other arguments, and transport_stable_batch
+        for the batched iterations.
+    """
+    n_iter = 0
+    for i in range(growth_iters):
+        if i == 0:
+            rowSums = gs
+        else:
+            previousRowSums = rowSums
+            rowSums = [tmap.sum(axis=1) / tmap.shape[1] for tmap in tmaps]
+            if tolerance is not None and all(np.linalg.norm(r - pr) <= tolerance * np.linalg.norm(pr)
+                                             for r, pr in zip(rowSums, previousRowSums)):
+                break
+
+        tmaps, duals = transport_stable_batch(Cs=Cs, lambda1=lambda1, lambda2=lambda2, epsilon=epsilon,
+                                              scaling_iter=scaling_iter, gs=rowSums, tau=tau, epsilon0=epsilon0,
+                                              numInnerItermax=inner_iter_max, extra_iter=1000, tolerance=tolerance,
+                                              batch_size=batch_size, precision=precision, duals=duals, log=True,
+                                              **kwargs)
+        n_iter += duals[0]['n_iter']
+    if log:
+        for d in duals:
+            d['n_iter'] = n_iter
+        return tmaps, duals
+    return tmaps
+
+
+def transport_stable_batch(Cs, lambda1, lambda2, epsilon, scaling_iter, gs, numInnerItermax, tau, epsilon0,
+                           extra_iter, tolerance=None, batch_size=50, precision='float64', duals=None, log=False):
+    """
+    Compute several optimal transports with the same parameters at once.
+    Args:
+
+        Cs: list of dense cost matrices, each one for a separate problem
+        gs: list of growth values for the input cells of each problem
+        duals: list of initial dual variables for each problem, as returned with log=True. The solver
+            only starts directly at the final epsilon when all of them are given
+        log: also return the list of final dual variables of each problem, see transport_stablev2
+
+    Notes:
+        The problems are padded to the same size and stacked, so that each scaling iteration performs
+        one batched matrix product for all of them. Padded cells have a zero weight in dx and dy,
+        and thus do not change the other cells' marginals. Early stopping with a tolerance waits for
+        all problems to converge. See transport_stablev2 for the other arguments.
+    """
+    warm_start = tau is not None
+    epsilon_final = epsilon
+
+    def get_reg(n):  # exponential decreasing
+        return float((epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final)
+
+    epsilon_i = epsilon0 if warm_start else epsilon
+    dtype = np.dtype(precision)
+    rows = np.array([C.shape[0] for C in Cs])
+    columns = np.array([C.shape[1] for C in Cs])
+    B, I, J = len(Cs), rows.max(), columns.max()
+    row_mask = np.arange(I) < rows[:, np.newaxis]
+    column_mask = np.arange(J) < columns[:, np.newaxis]
+
+    # Padded cells cost nothing to reach from real cells, and can not reach each other
+    C = np.zeros((B, I, J), dtype=dtype)
+    C[~(row_mask[:, :, np.newaxis] | column_mask[:, np.newaxis, :])] = np.inf
+    p = np.ones((B, I), dtype=dtype)
+    q = np.ones((B, J), dtype=dtype)
+    for k in range(B):
+        C[k, :rows[k], :columns[k]] = Cs[k]
+        p[k, :rows[k]] = gs[k]
+        q[k, :columns[k]] = np.average(gs[k])
+    dx = (row_mask / rows[:, np.newaxis]).astype(dtype)
+    dy = (column_mask / columns[:, np.newaxis]).astype(dtype)
+
+    u = np.zeros((B, I), dtype=dtype)
+    v = np.zeros((B, J), dtype=dtype)
+    a = np.ones((B, I), dtype=dtype)
+    b = np.ones((B, J), dtype=dtype)
+    if duals is not None and all(d is not None for d in duals):
+        for k in range(B):
+            u[k, :rows[k]], v[k, :columns[k]] = absorb_duals(duals[k], dtype)
+        epsilon_i = epsilon
+
+    def stabilized_kernels():
+        return np.exp((u[:, :, np.newaxis] - C + v[:, np.newaxis, :]) / epsilon_i)
+
+    K = stabilized_kernels()
+    alpha1 = lambda1 / (lambda1 + epsilon_i)
+    alpha2 = lambda2 / (lambda2 + epsilon_i)
+    epsilon_index = 0
+    iterations_since_epsilon_adjusted = 0
+    previous_duals = None
+
+    def converged(a, b):
+        # Same criterion as transport_stablev2, required for every problem
+        nonlocal previous_duals
+        if epsilon_i != epsilon_final:
+            previous_duals = None
+            return False
+        _u = np.where(row_mask, u + epsilon_i * np.log(a), 0)
+        _v = np.where(column_mask, v + epsilon_i * np.log(b), 0)
+        row_marginal = a * np.matmul(K, (b * dy)[:, :, np.newaxis])[:, :, 0]
+        target = np.where(row_mask, p * np.exp(-_u / lambda1), 0)
+        marginal_error = np.sum(np.abs(np.where(row_mask, row_marginal, 0) - target), axis=1) / np.sum(target, axis=1)
+        if previous_duals is None:
+            dual_change = np.inf
+        else:
+            dual_change = np.maximum(
+                np.linalg.norm(_u - previous_duals[0], axis=1) / (1 + np.linalg.norm(_u, axis=1)),
+                np.linalg.norm(_v - previous_duals[1], axis=1) / (1 + np.linalg.norm(_v, axis=1)))
+        previous_duals = (_u, _v)
+        return np.all(marginal_error < tolerance) and np.all(dual_change < tolerance)
+
+    # Buffers reused by every scaling iteration
+    weighted_b = np.empty((B, J), dtype=dtype)
+    weighted_a = np.empty((B, I), dtype=dtype)
+    row_sums = np.empty((B, I), dtype=dtype)
+    column_sums = np.empty((B, J), dtype=dtype)
+
+    def scaling_factors():
+        return p ** alpha1 * np.exp(-u / (lambda1 + epsilon_i)), q ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+
+    def scaling_step(a, b):
+        np.multiply(b, dy, out=weighted_b)
+        np.matmul(K, weighted_b[:, :, np.newaxis], out=row_sums[:, :, np.newaxis])
+        largest = update_scaling(row_sums.ravel(), factor_a.ravel(), alpha1, a.ravel())
+        np.multiply(a, dx, out=weighted_a)
+        np.matmul(weighted_a[:, np.newaxis, :], K, out=column_sums[:, np.newaxis, :])
+        return max(largest, update_scaling(column_sums.ravel(), factor_b.ravel(), alpha2, b.ravel()))
+
+    factor_a, factor_b = scaling_factors()
+    done = False
+    n_iter = 0
+    for i in range(scaling_iter):
+        # scaling iteration
+        n_iter += 1
+        largest = scaling_step(a, b)
+
+        # stabilization
+        iterations_since_epsilon_adjusted += 1
+        if largest > tau:
+            u = u + epsilon_i * np.log(a)
+            v = v + epsilon_i * np.log(b)  # absorb
+            K = stabilized_kernels()
+            factor_a, factor_b = scaling_factors()
+            a.fill(1)
+            b.fill(1)
+
+        if (warm_start and epsilon_i != epsilon_final and iterations_since_epsilon_adjusted == numInnerItermax):
+            epsilon_index += 1
+            iterations_since_epsilon_adjusted = 0
+            u = u + epsilon_i * np.log(a)
+            v = v + epsilon_i * np.log(b)  # absorb
+            epsilon_i = get_reg(epsilon_index)
+            if tolerance is not None and epsilon_i - epsilon_final <= tolerance * epsilon_final:
+                epsilon_i = epsilon_final
+            alpha1 = lambda1 / (lambda1 + epsilon_i)
+            alpha2 = lambda2 / (lambda2 + epsilon_i)
+            K = stabilized_kernels()
+            factor_a, factor_b = scaling_factors()
+            a.fill(1)
+            b.fill(1)
+
+        if tolerance is not None and (i + 1) % batch_size == 0 and converged(a, b):
+            done = True
+            break
+
+    if not done:
+        for i in range(extra_iter):
+            n_iter += 1
+            scaling_step(a, b)
+            if tolerance is not None and (i + 1) % batch_size == 0 and converged(a, b):
+                break
+
+    tmaps = [(K[k, :rows[k], :columns[k]].T * a[k, :rows[k]]).T * b[k, :columns[k]] for k in range(B)]
+    if log:
+        return tmaps, [{'u': u[k, :rows[k]], 'v': v[k, :columns[k]], 'a': a[k, :rows[k]], 'b': b[k, :columns[k]],
+                        'epsilon': epsilon_i, 'n_iter': n_iter} for k in range(B)]
+    return tmaps
+
+
+def matvec(K, x, out):
+    """
+    Compute K.dot(x) into out. Dense products do not allocate any memory.
+    """
+    if scipy.sparse.issparse(K) or isinstance(K, LowRankMatrix):
+        out[:] = K.dot(x)
+    else:
+        np.dot(K, x, out=out)
+
+
+try:
+    import numba
+
+
+    @numba.njit(nogil=True, cache=True)
+    def update_scaling(sums, factors, alpha, out):
+        """
+        Compute the scaling update out = factors / sums^alpha in place.
+        Returns the largest updated value.
+        """
+        result = 0.0
+        for i in range(sums.shape[0]):
+            out[i] = factors[i] / sums[i] ** alpha
+            result = max(result, out[i])
+        return result
+
+
+    @numba.njit(nogil=True, cache=True)
+    def extrapolate(x, x_hat, omega):
+        """
+        Over-relax a scaling update in place, x = x^(1 - omega) * x_hat^omega.
+        """
+        for i in range(x.shape[0]):
+            x[i] = x[i] ** (1 - omega) * x_hat[i] ** omega
+except ImportError:
+    def update_scaling(sums, factors, alpha, out):
+        """
+        Compute the scaling update out = factors / sums^alpha in place.
+        Returns the largest updated value. Install numba for a compiled version.
+        """
+        np.power(sums, -alpha, out=out)
+        np.multiply(out, factors, out=out)
+        return out.max()
+
+
+    def extrapolate(x, x_hat, omega):
+        """
+        Over-relax a scaling update in place, x = x^(1 - omega) * x_hat^omega.
+        """
+        if omega != 1:
+            np.power(x, 1 - omega, out=x)
+            np.power(x_hat, omega, out=x_hat)
+            np.multiply(x, x_hat, out=x)
+        else:
+            x[:] = x_hat
+
+
+RELAXATION_WINDOW = 10
+MAX_RELAXATION = 1.9
+RELAXATION_BACKOFF = 0.75
+
+
+def relaxation_factor(initial_residual, final_residual, iterations):
+    """
+    Compute the over-relaxation factor for Sinkhorn iterations with an estimated convergence rate.
+    Args:
+
+        initial_residual: size of a plain Sinkhorn update
+        final_residual: size of the same update after the given number of plain iterations
+        iterations: number of plain iterations between both residuals
+
+    Notes:
+        The rate theta is the geometric mean of the residual ratios. The factor 2 / (1 + sqrt(1 - theta))
+        is the optimal one for a linear convergence at that rate, capped at MAX_RELAXATION. No relaxation
+        is performed when the residuals do not decrease.
+    """
+    if not initial_residual > 0 or not final_residual < initial_residual:
+        return 1.0
+    theta = (final_residual / initial_residual) ** (1.0 / iterations)
+    return float(min(2 / (1 + np.sqrt(1 - theta)), MAX_RELAXATION))
+
+
+def absorb_duals(duals, dtype=np.float64):
+    """
+    Compute the full dual potentials from the dual variables returned by the solvers with log=True.
+
+    Parameters
+    ----------
+    duals : dict
+        The absorbed dual variables 'u' and 'v', the scaling vectors 'a' and 'b', and 'epsilon'
+    dtype : numpy.dtype, optional
+        The type of the result
+
+    Returns
+    -------
+    u, v : 1-D ndarray
+        The dual potentials for the rows and the columns
+    """
+    epsilon = duals['epsilon']
+    u = np.asarray(duals['u'] + epsilon * np.log(duals['a']), dtype=dtype)
+    v = np.asarray(duals['v'] + epsilon * np.log(duals['b']), dtype=dtype)
+    return u, v
+
+
+def stabilized_kernel(C, u, v, epsilon, out=None):
+    """
+    Compute the Gibbs kernel exp((u_i + v_j - C_ij) / epsilon) with the absorbed dual variables u and v.
+
+    Parameters
+    ----------
+    C : 2-D ndarray, scipy.sparse matrix or LandmarkCost
+        The cost matrix. For sparse matrices, the kernel is only computed on the stored entries.
+        For a LandmarkCost, a low-rank approximation of the kernel is returned, see nystrom_kernel
+    u : 1-D ndarray
+        Absorbed dual variable for the rows
+    v : 1-D ndarray
+        Absorbed dual variable for the columns
+    epsilon : float
+        Entropy regularization parameter
+    out : 2-D ndarray, optional
+        Buffer the kernel of a dense cost matrix is written to, such as the previous kernel
+
+    Returns
+    -------
+    K : 2-D ndarray, scipy.sparse.csr_matrix or LowRankMatrix
+        The stabilized kernel, with the same sparsity structure as C
+    """
+    if isinstance(C, LandmarkCost):
+        return nystrom_kernel(C, u, v, epsilon)
+    if scipy.sparse.issparse(C):
+        C = C.tocsr()
+        rows = np.repeat(np.arange(C.shape[0]), np.diff(C.indptr))
+        K = C.copy()
+        K.data = np.exp((u[rows] + v[C.indices] - C.data) / epsilon)
+        return K
+    if out is None:
+        out = np.empty(C.shape, dtype=C.dtype)
+    # One pass per row tile, without any temporary matrix
+    for tile in row_tiles(C.shape):
+        np.subtract(u[tile, np.newaxis], C[tile], out=out[tile])
+        out[tile] += v
+        out[tile] *= 1 / epsilon
+        np.exp(out[tile], out=out[tile])
+    return out
+
+
+class LandmarkCost:
+    """
+    Squared euclidean cost between two sets of cells, C_ij = |x_i - y_j|^2, that is never computed in full.
+    The nystrom solver approximates its Gibbs kernel from the kernel between each cell and a few landmarks.
+
+    Args:
+
+        x: coordinates of the input cells, scaled so that the cost is their squared distance
+        y: coordinates of the output cells, in the same space
+        landmarks: coordinates of the landmarks, in the same space
+    """
+
+    def __init__(self, x, y, landmarks):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.landmarks = np.asarray(landmarks)
+        self.shape = (self.x.shape[0], self.y.shape[0])
+
+    def astype(self, dtype):
+        return LandmarkCost(self.x.astype(dtype), self.y.astype(dtype), self.landmarks.astype(dtype))
+
+    def toarray(self):
+        return squared_distances(self.x, self.y)
+
+
+class LowRankMatrix:
+    """
+    Matrix stored as the product of two thin factors, left.dot(right.T).
+    Only supports the operations needed by the solvers, call toarray() for anything else.
+    Negative entries of the product are treated as zero, see toarray().
+    """
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.shape = (left.shape[0], right.shape[0])
+
+    @property
+    def T(self):
+        return LowRankMatrix(self.right, self.left)
+
+    def dot(self, x):
+        # The nystrom approximation is not guaranteed to be positive
+        return np.maximum(self.left.dot(self.right.T.dot(x)), np.finfo(self.left.dtype).tiny)
+
+    def sum(self, axis=None):
+        if axis is None:
+            return self.left.sum(axis=0).dot(self.right.sum(axis=0))
+        return self.dot(np.ones(self.shape[1], dtype=self.left.dtype)) if axis == 1 else \
+            self.T.dot(np.ones(self.shape[0], dtype=self.left.dtype))
+
+    def scale(self, a, b):
+        """
+        Compute diag(a) . self . diag(b)
+        """
+        return LowRankMatrix(self.left * a[:, np.newaxis], self.right * b[:, np.newaxis])
+
+    def toarray(self):
+        """
+        Densify the matrix, clamping its negative entries to zero.
+
+        The nystrom approximation of a kernel can have negative entries, that dot() already clamps.
+        Each row is rescaled to keep the row sums of sum(axis=1), so that the densified transport map
+        has the growth the solver converged to. Densifying is therefore lossy where the approximation is poor.
+        """
+        x = np.maximum(self.left.dot(self.right.T), 0)
+        row_sums = x.sum(axis=1)
+        target = self.sum(axis=1)
+        positive = row_sums > 0
+        x[positive] *= (target[positive] / row_sums[positive])[:, np.newaxis]
+        return x
+
+
+# Number of entries of the row tiles dense matrices are built in, small enough to stay in cache
+TILE_ELEMENTS = 2 ** 16
+# Minimum number of rows of a tile, so that the products of wide matrices remain matrix-matrix products
+TILE_MIN_ROWS = 64
+
+
+def row_tiles(shape):
+    """
+    Split the rows of a matrix of the given shape into slices of about TILE_ELEMENTS entries,
+    and at least TILE_MIN_ROWS rows.
+    """
+    rows = max(TILE_MIN_ROWS, TILE_ELEMENTS // max(1, shape[1]))
+    return [slice(start, min(start + rows, shape[0])) for start in range(0, shape[0], rows)]
+
+
+def squared_distances(x, y, out=None):
+    """
+    Compute the squared euclidean distances between the rows of x and y, |x|^2 - 2 x.y + |y|^2.
+
+    The matrix is built in row tiles directly in out, with one matrix product per tile,
+    so that no temporary of the size of the result is allocated. Sparse x and y are multiplied
+    as sparse matrices, without densifying the cells by genes matrices.
+
+    Args:
+
+        x: coordinates of the input cells, dense or sparse
+        y: coordinates of the output cells, dense or sparse
+        out: buffer for the result, such as a numpy.memmap. A new array of the type of x by default
+    """
+    if out is None:
+        out = np.empty((x.shape[0], y.shape[0]), dtype=x.dtype)
+    if scipy.sparse.issparse(x) or scipy.sparse.issparse(y):
+        x = scipy.sparse.csr_matrix(x, dtype=out.dtype)
+        y = scipy.sparse.csr_matrix(y, dtype=out.dtype)
+        x_norms = np.asarray(x.multiply(x).sum(axis=1), dtype=out.dtype).ravel()
+        y_norms = np.asarray(y.multiply(y).sum(axis=1), dtype=out.dtype).ravel()
+        y = y.T.tocsr()
+    else:
+        x_norms = np.einsum('ij,ij->i', x, x)
+        y_norms = np.einsum('ij,ij->i', y, y)
+        y = np.ascontiguousarray(y.T)
+    for tile in row_tiles(out.shape):
+        if scipy.sparse.issparse(x):
+            out[tile] = x[tile].dot(y).toarray()
+        else:
+            # np.dot requires an output of the exact type, that can be a view of out
+            np.dot(x[tile], y, out=out[tile])
+        out[tile] *= -2
+        out[tile] += x_norms[tile, np.newaxis]
+        out[tile] += y_norms
+        np.maximum(out[tile], 0, out=out[tile])
+    return out
+
+
+def nystrom_kernel(C, u, v, epsilon):
+    """
+    Approximate the Gibbs kernel exp((u_i + v_j - C_ij) / epsilon) of a LandmarkCost with the Nystrom method,
+    K ~ K_xz K_zz^-1 K_zy where z are the landmarks. The dual variables are absorbed into K_xz and K_zy.
+
+    Args:
+
+        C: LandmarkCost
+        u: absorbed dual variable for the rows
+        v: absorbed dual variable for the columns
+        epsilon: entropy regularization parameter
+
+    Returns:
+        A LowRankMatrix whose rank is at most the number of landmarks
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(np.exp(-squared_distances(C.landmarks, C.landmarks) / epsilon))
+    # Drop the directions that are lost in rounding errors
+    keep = eigenvalues > np.sqrt(np.finfo(eigenvalues.dtype).eps) * eigenvalues[-1]
+    whitening = eigenvectors[:, keep] / np.sqrt(eigenvalues[keep])
+    left = np.exp((u[:, np.newaxis] - squared_distances(C.x, C.landmarks)) / epsilon).dot(whitening)
+    right = np.exp((v[:, np.newaxis] - squared_distances(C.y, C.landmarks)) / epsilon).dot(whitening)
+    return LowRankMatrix(left, right)
+
+
+def sparsify_cost_matrix(C, epsilon, kernel_threshold):
+    """
+    Keep only the pairs whose kernel value exp(-C_ij / epsilon) is at least kernel_threshold.
+
+    The cheapest pair of every row and every column is always kept, so that no cell is left
+    without a possible destination or origin. The dense cost matrix is required, so this only
+    reduces the memory of the solver, not of the cost matrix: use a nearest neighbors cost
+    matrix instead to never build the dense one.
+
+    Parameters
+    ----------
+    C : 2-D ndarray
+        The dense cost matrix
+    epsilon : float
+        Entropy regularization parameter
+    kernel_threshold : float
+        Kernel entries below this value are dropped, none with 0
+
+    Returns
+    -------
+    C : scipy.sparse.csr_matrix
+        The cost of the kept pairs. Zero-cost pairs are stored explicitly.
+    """
+    if kernel_threshold < 0:
+        raise ValueError("kernel_threshold must be non-negative, got {}".format(kernel_threshold))
+    if kernel_threshold == 0:
+        mask = np.ones(C.shape, dtype=bool)
+    else:
+        mask = C <= -epsilon * np.log(kernel_threshold)
+    mask[np.arange(C.shape[0]), C.argmin(axis=1)] = True
+    mask[C.argmin(axis=0), np.arange(C.shape[1])] = True
+    rows, cols = np.nonzero(mask)
+    return scipy.sparse.csr_matrix((C[rows, cols], (rows, cols)), shape=C.shape)
+
+
+def transport_stable_log(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, numInnerItermax, tau,
+                         epsilon0, extra_iter, tolerance=None, batch_size=50, precision='float64', block_size=1024,
+                         duals=None, log=False, trace_stride=None, dx=None, dy=None):
+    """
+    Compute the optimal transport with log-domain numerics.
+
+    Same iterations as transport_stablev2, but the dual potentials are updated directly with
+    log-sum-exp reductions over tiles of block_size rows of C. The kernel exp(-C / epsilon)
+    is never materialized, so no stabilization is needed and changing epsilon is free.
+    Args:
+
+        C: cost matrix to transport cell i to cell j
+        lambda1: regularization parameter for marginal constraint for p.
+        lambda2: regularization parameter for marginal constraint for q.
+        epsilon: entropy parameter
+        scaling_iter: number of scaling iterations
+        g: growth value for input cells
+        tau: unused, kept for compatibility with transport_stablev2. Epsilon scaling is enabled when not None
+        tolerance: stop as soon as both the marginal violation and the relative change in the dual
+            variables are below this value. None to always perform scaling_iter + extra_iter iterations
+        batch_size: number of scaling iterations between each convergence check
+        precision: floating point type used for all computations, 'float64' or 'float32'
+        block_size: number of rows of C processed at once
+        duals: dict of initial dual variables, as returned with log=True. When given, the solver starts
+            directly at the final epsilon
+        log: also return a dict with the final dual variables, in the same format as transport_stablev2
+        trace_stride: with log=True, also return a trace of the solver, see transport_stablev2.
+            There are no stabilizations in the log domain
+        dx: weight of each input cell, 1 / C.shape[0] by default, see transport_stablev2
+        dy: weight of each output cell, 1 / C.shape[1] by default
+    """
+    warm_start = tau is not None
+    epsilon_final = epsilon
+
+    def get_reg(n):  # exponential decreasing
+        return float((epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final)
+
+    epsilon_i = epsilon0 if warm_start else epsilon
+    dtype = np.dtype(precision)
+    C = np.asarray(C, dtype=dtype)
+    I, J = C.shape
+    log_dx = np.full(I, -np.log(I), dtype=dtype) if dx is None else np.log(np.asarray(dx, dtype=dtype))
+    log_dy = np.full(J, -np.log(J), dtype=dtype) if dy is None else np.log(np.asarray(dy, dtype=dtype))
+    log_p = np.log(np.asarray(g, dtype=dtype))
+    log_q = np.full(J, np.log(np.average(g)), dtype=dtype)
+    blocks = [(start, min(start + block_size, I)) for start in range(0, I, block_size)]
+
+    def row_lse(v):
+        # log(sum_j exp((v_j - C_ij) / epsilon) dy_j) for each row i
+        result = np.empty(I, dtype=dtype)
+        for start, end in blocks:
+            tile = (v - C[start:end]) / epsilon_i
+            tile += log_dy
+            tile_max = tile.max(axis=1)
+            tile -= tile_max[:, np.newaxis]
+            np.exp(tile, out=tile)
+            result[start:end] = np.log(tile.sum(axis=1)) + tile_max
+        return result
+
+    def column_lse(u):
+        # log(sum_i exp((u_i - C_ij) / epsilon) dx_i) for each column j, streamed over row tiles
+        running_max = np.full(J, -np.inf, dtype=dtype)
+        running_sum = np.zeros(J, dtype=dtype)
+        for start, end in blocks:
+            tile = (u[start:end, np.newaxis] - C[start:end]) / epsilon_i
+            tile += log_dx[start:end, np.newaxis]
+            tile_max = np.maximum(running_max, tile.max(axis=0))
+            running_sum *= np.exp(running_max - tile_max)
+            tile -= tile_max
+            np.exp(tile, out=tile)
+            running_sum += tile.sum(axis=0)
+            running_max = tile_max
+        return np.log(running_sum) + running_max
+
+    u = np.zeros(I, dtype=dtype)
+    v = np.zeros(J, dtype=dtype)
+    if duals is not None:
+        u, v = absorb_duals(duals, dtype)
+        epsilon_i = epsilon
+    epsilon_index = 0
+    iterations_since_epsilon_adjusted = 0
+    previous_duals = None
+
+    def update(u, v):
+        u = lambda1 / (lambda1 + epsilon_i) * epsilon_i * (log_p - row_lse(v))
+        v = lambda2 / (lambda2 + epsilon_i) * epsilon_i * (log_q - column_lse(u))
+        return u, v
+
+    def converged(u, v):
+        # Only compare dual variables computed with the final epsilon
+        nonlocal previous_duals
+        if epsilon_i != epsilon_final:
+            previous_duals = None
+            return False
+        # At the fixed point, the row marginal is p * exp(-u / lambda1)
+        row_marginal = np.exp(u / epsilon_i + row_lse(v))
+        target = np.exp(log_p - u / lambda1)
+        marginal_error = np.sum(np.abs(row_marginal - target)) / np.sum(target)
+        if previous_duals is None:
+            dual_change = np.inf
+        else:
+            dual_change = max(np.linalg.norm(u - previous_duals[0]) / (1 + np.linalg.norm(u)),
+                              np.linalg.norm(v - previous_duals[1]) / (1 + np.linalg.norm(v)))
+        previous_duals = (u, v)
+        return marginal_error < tolerance and dual_change < tolerance
+
+    start_time = time.time()
+    trace = []
+
+    def record(u, v):
+        # Relative L1 distances of the marginals to their values at the fixed point
+        row_marginal = np.exp(u / epsilon_i + row_lse(v))
+        column_marginal = np.exp(v / epsilon_i + column_lse(u))
+        row_target = np.exp(log_p - u / lambda1)
+        column_target = np.exp(log_q - v / lambda2)
+        trace.append({'iteration': n_iter, 'epsilon': epsilon_i,
+                      'row_marginal_error': float(np.sum(np.abs(row_marginal - row_target)) / np.sum(row_target)),
+                      'column_marginal_error': float(np.sum(np.abs(column_marginal - column_target))
+                                                     / np.sum(column_target)),
+                      'stabilizations': 0, 'time': time.time() - start_time})
+
+    done = False
+    n_iter = 0
+    for i in range(scaling_iter):
+        n_iter += 1
+        u, v = update(u, v)
+        iterations_since_epsilon_adjusted += 1
+        if (warm_start and epsilon_i != epsilon_final and iterations_since_epsilon_adjusted == numInnerItermax):
+            epsilon_index += 1
+            iterations_since_epsilon_adjusted = 0
+            epsilon_i = get_reg(epsilon_index)
+            if tolerance is not None and epsilon_i - epsilon_final <= tolerance * epsilon_final:
+                epsilon_i = epsilon_final
+
+        if trace_stride is not None and n_iter % trace_stride == 0:
+            record(u, v)
+        if tolerance is not None and (i + 1) % batch_size == 0 and converged(u, v):
+            done = True
+            break
+
+    if not done:
+        for i in range(extra_iter):
+            n_iter += 1
+            u, v = update(u, v)
+            if trace_stride is not None and n_iter % trace_stride == 0:
+                record(u, v)
+            if tolerance is not None and (i + 1) % batch_size == 0 and converged(u, v):
+                break
+
+    if trace_stride is not None and (len(trace) == 0 or trace[-1]['iteration'] != n_iter):
+        record(u, v)
+
+    tmap = np.empty((I, J), dtype=dtype)
+    for start, end in blocks:
+        tile = tmap[start:end]
+        np.subtract(v, C[start:end], out=tile)
+        tile += u[start:end, np.newaxis]
+        tile /= epsilon_i
+        np.exp(tile, out=tile)
+    if log:
+        duals = {'u': u, 'v': v, 'a': np.ones(I, dtype=dtype), 'b': np.ones(J, dtype=dtype),
+                 'epsilon': epsilon_i, 'n_iter': n_iter}
+        if trace_stride is not None:
+            duals['trace'] = trace
+        return tmap, duals
+    return tmap
 
 
 def transport_stable(p, q, C, lambda1, lambda2, epsilon, scaling_iter, g):
@@ -495,21 +1422,107 @@ def optimal_transport_with_entropy(cost_matrix, growth_rate, p=None, q=None,
             'lambda2': lambda2 * l0, 'epsilon': epsilon * e0}
 
 
-def compute_pca(m1, m2, n_components):
-    matrices = list()
-    matrices.append(m1 if not scipy.sparse.isspmatrix(m1) else m1.toarray())
-    matrices.append(m2 if not scipy.sparse.isspmatrix(m2) else m2.toarray())
-    x = np.vstack(matrices)
-    mean_shift = x.mean(axis=0)
-    x = x - mean_shift
-    pca = sklearn.decomposition.PCA(n_components=n_components, random_state=58951)
-    pca.fit(x.T)
-    comp = pca.components_.T
+class TruncatedPCA:
+    """
+    Truncated PCA of the cells of two timepoints, as computed by compute_pca.
+    Its attributes are those of a sklearn.decomposition.PCA fitted on the transposed, gene-centered expression matrix.
+
+    Args:
+
+        components: coordinates of the cells, one row per component
+        singular_values: singular value of each component
+        mean: mean over genes of each gene-centered cell
+        gene_components: direction of each component in gene space, one row per component
+    """
+
+    def __init__(self, components, singular_values, mean, gene_components):
+        self.components_ = components
+        self.singular_values_ = singular_values
+        self.mean_ = mean
+        self.gene_components_ = gene_components
+        self.n_components_ = len(singular_values)
+
+
+def compute_pca(m1, m2, n_components, n_iter=7, n_oversamples=10):
+    """
+    Compute the local PCA coordinates of the cells of two timepoints with a truncated SVD.
+
+    The expression matrix is centered on the mean of each gene, then of each cell. As with
+    sklearn.decomposition.PCA(svd_solver='auto'), the exact SVD is computed if the matrix has at most
+    500 rows and columns or n_components is at least 80% of its smallest dimension. Otherwise a randomized
+    SVD is used, where the centering is implicit, so that sparse matrices are never densified, and only
+    the products of the expression matrix with a few vectors are computed.
+
+    Args:
+
+        m1: expression matrix of the first timepoint, ndarray or scipy.sparse matrix
+        m2: expression matrix of the second timepoint
+        n_components: number of components
+        n_iter: number of power iterations of the randomized SVD
+        n_oversamples: number of additional random vectors of the randomized SVD
+
+    Returns:
+        The coordinates of the cells of m1 and m2, the TruncatedPCA and the mean of each gene.
+        The coordinates are scaled by the inverse of the singular values of each component.
+    """
+    if scipy.sparse.issparse(m1) or scipy.sparse.issparse(m2):
+        x = scipy.sparse.vstack((m1, m2)).tocsr()
+    else:
+        x = np.vstack((m1, m2))
+    mean_shift = np.asarray(x.mean(axis=0)).ravel()
+    cell_means = np.asarray(x.mean(axis=1)).ravel() - mean_shift.mean()
+
+    def matmat(q):
+        # centered x times q
+        return np.asarray(x.dot(q)) - mean_shift.dot(q) - np.outer(cell_means, q.sum(axis=0))
+
+    def rmatmat(q):
+        # transposed centered x times q
+        return np.asarray(x.T.dot(q)) - np.outer(mean_shift, q.sum(axis=0)) - cell_means.dot(q)
+
+    if max(x.shape) <= 500 or n_components >= 0.8 * min(x.shape):
+        centered = x.toarray() if scipy.sparse.issparse(x) else np.array(x)
+        centered -= mean_shift
+        centered -= cell_means[:, np.newaxis]
+        comp, singular_values, gene_components = np.linalg.svd(centered, full_matrices=False)
+        comp = comp[:, :n_components]
+    else:
+        random_state = np.random.RandomState(58951)
+        size = min(n_components + n_oversamples, *x.shape)
+        q = np.linalg.qr(matmat(random_state.normal(size=(x.shape[1], size))))[0]
+        for i in range(n_iter):
+            q = np.linalg.qr(rmatmat(q))[0]
+            q = np.linalg.qr(matmat(q))[0]
+        u, singular_values, gene_components = np.linalg.svd(rmatmat(q).T, full_matrices=False)
+        comp = q.dot(u[:, :n_components])
+    pca = TruncatedPCA(comp.T, singular_values[:n_components], cell_means, gene_components[:n_components])
     m1_len = m1.shape[0]
-    m2_len = m2.shape[0]
-    pca_1 = comp[0:m1_len]
-    pca_2 = comp[m1_len:(m1_len + m2_len)]
-    return pca_1, pca_2, pca, mean_shift
+    return comp[:m1_len], comp[m1_len:], pca, mean_shift
+
+
+def project_on_pca(pca, mean_shift, arr):
+    """
+    Project new cells on the local PCA basis of compute_pca.
+
+    Parameters
+    ----------
+    pca : TruncatedPCA
+        The PCA returned by compute_pca
+    mean_shift : 1-D ndarray
+        The mean returned by compute_pca
+    arr : ndarray or scipy.sparse matrix
+        The cells to project. Sparse matrices are not densified
+
+    Returns
+    -------
+    result : ndarray
+        The coordinates of the cells, on the same scale as those returned by compute_pca
+    """
+    directions = pca.gene_components_.T
+    cell_means = np.asarray(arr.mean(axis=1)).ravel() - mean_shift.mean()
+    projection = np.asarray(arr.dot(directions)) - mean_shift.dot(directions) \
+                 - np.outer(cell_means, directions.sum(axis=0))
+    return projection / pca.singular_values_
 
 
 def get_pca(dim, *args):
@@ -5,7 +5,6 @@ import anndata
 import numpy as np
 import pandas as pd
 import scipy
-import sklearn.decomposition
 import sklearn.metrics
 
 import wot.io
@@ -197,28 +196,16 @@ class OptimalTransportHelper:
                     continue
 
             if args.local_pca is not None and args.local_pca > 0:
-                import scipy.sparse
-                matrices = list()
-                matrices.append(p0_full.X if not scipy.sparse.isspmatrix(p0_full.X) else p0_full.X.toarray())
-                matrices.append(p1_full.X if not scipy.sparse.isspmatrix(p1_full.X) else p1_full.X.toarray())
-
-                x = np.vstack(matrices)
-                mean_shift = x.mean(axis=0)
-                x = x - mean_shift
-                pca = sklearn.decomposition.PCA(n_components=args.local_pca)
-                pca.fit(x.T)
-                x = pca.components_.T
-                p0_full = anndata.AnnData(x[0:len(t0_indices)],
+                p0_x, p1_x, pca, mean_shift = wot.ot.compute_pca(p0_full.X, p1_full.X, args.local_pca)
+                p0_full = anndata.AnnData(p0_x,
                                           p0_full.obs,
                                           pd.DataFrame(index=pd.RangeIndex(start=0, stop=args.local_pca, step=1)))
 
-                p1_full = anndata.AnnData(x[len(t0_indices):len(t0_indices) + len(t1_indices)],
+                p1_full = anndata.AnnData(p1_x,
                                           p1_full.obs,
                                           pd.DataFrame(index=pd.RangeIndex(start=0, stop=args.local_pca, step=1)))
                 if p0_5_full is not None:  # compute PCA only on local coordinates
-                    U = np.vstack(matrices).T.dot(pca.components_.T).dot(np.diag(1 / pca.singular_values_))
-                    y = p0_5_full.X - mean_shift
-                    p0_5_full = anndata.AnnData(np.diag(1 / pca.singular_values_).dot(U.T.dot(y.T)).T, p0_5_full.obs,
+                    p0_5_full = anndata.AnnData(wot.ot.project_on_pca(pca, mean_shift, p0_5_full.X), p0_5_full.obs,
                                                 pd.DataFrame(index=pd.RangeIndex(start=0, stop=args.local_pca, step=1)))
                 self.eigenvals = np.diag(pca.singular_values_)
                 print(self.eigenvals)
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import copy
+import json
 import os
+import socket
+import tempfile
+import time
 
 import anndata
 import itertools
@@ -8,10 +14,16 @@ import numpy as np
 import pandas as pd
 import scipy
 import sklearn
+import sklearn.neighbors
 
 import wot.io
 import wot.ot
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 class OTModel:
     """
@@ -31,11 +43,41 @@ class OTModel:
         considered as transport maps.
         The default prefix for transport maps is 'tmaps'
     max_threads : int, optional
-        Maximum number of threads to use when computing transport maps
+        Maximum number of threads to use when computing transport maps. With several threads, they are
+        split between transport maps computed at once and the BLAS threads of each one, see map_in_workers
+    max_memory : float, optional
+        Memory budget in gigabytes for the transport maps computed at once with max_threads > 1.
+        Transport maps are dispatched largest first, as long as their estimated memory fits in the budget,
+        see estimate_transport_map_cost
+    shard : str or (int, int), optional
+        Only compute the day pairs of shard i out of N, as 'i/N' or (i, N) with 0 <= i < N,
+        to split the transport maps between independent processes
+    work_queue : bool, optional
+        Claim each transport map with a lock file in the transport map directory before computing it,
+        so that processes sharing the directory, even on different nodes, never compute the same one
+    lock_timeout : float, optional
+        Seconds after which the lock of a transport map is reclaimed with work_queue, for processes that crashed
+        on another host. Locks of processes that are no longer running on this host are always reclaimed
+    cache_pca : bool, optional
+        Save the local PCA coordinates of each day pair next to the transport maps, and reuse them
+        in later runs with the same cells, genes and number of components, see wot.ot.EmbeddingCache
+    global_pca : bool, optional
+        Use a single PCA of all cells, computed once, instead of a local PCA for each day pair
     **kwargs : dict
         Dictionnary of parameters. Will be inserted as is into OT configuration.
     """
 
+    SWEEP_PARAMETERS = ('epsilon', 'lambda1', 'lambda2')
+    # Maximum number of entries in a stack of padded cost matrices solved at once.
+    # Small enough for the stack to stay in cache during the scaling iterations.
+    MAX_BATCH_ELEMENTS = 2 ** 16
+    # Kernel entries per BLAS thread. Smaller matrix-vector products are slowed down by more threads.
+    BLAS_ENTRIES_PER_THREAD = 2 ** 20
+    # Parameters that do not change the transport maps, left out of their fingerprints
+    UNFINGERPRINTED_PARAMETERS = ('trace_stride', 'cost_matrix_dir')
+    # Seconds to wait for the manifest lock before assuming it was left by a crashed process
+    MANIFEST_LOCK_TIMEOUT = 60
+
     def __init__(self, matrix, tmap_out, max_threads=None, **kwargs):
         tmap_dir, tmap_prefix = os.path.split(tmap_out) if tmap_out is not None else (None, None)
         self.matrix = matrix
@@ -49,7 +91,18 @@ class OTModel:
         ncounts = kwargs.pop('ncounts', None)
         ncells = kwargs.pop('ncells', None)
         self.force = kwargs.pop('force', False)
+        self.warm_start = kwargs.pop('warm_start', False)
         self.output_file_format = kwargs.pop('output_file_format', 'h5ad')
+        cache_pca = kwargs.pop('cache_pca', False)
+        global_pca = kwargs.pop('global_pca', False)
+        self.max_memory = kwargs.pop('max_memory', None)
+        self.work_queue = kwargs.pop('work_queue', False)
+        self.lock_timeout = kwargs.pop('lock_timeout', None)
+        self.shard = kwargs.pop('shard', None)
+        if isinstance(self.shard, str):
+            self.shard = tuple(int(x) for x in self.shard.split('/'))
+        if self.shard is not None and (len(self.shard) != 2 or not 0 <= self.shard[0] < self.shard[1]):
+            raise ValueError("shard must be i/N with 0 <= i < N")
         if gene_filter is not None:
             if os.path.isfile(gene_filter):
                 gene_ids = pd.read_table(gene_filter, index_col=0, header=None) \
@@ -127,8 +180,8 @@ class OTModel:
             except Exception:
                 import multiprocessing
                 max_usable_cores = multiprocessing.cpu_count()
-            if kwargs.pop('fast', False):
-                wot.io.verbose("Fast mode. Using all but one core")
+            if kwargs.pop('fast', False) or self.max_memory is not None:
+                wot.io.verbose("Fast mode or memory budget. Using all but one core")
                 self.max_threads = max_usable_cores - 1
             else:
                 self.max_threads = 1
@@ -138,9 +191,13 @@ class OTModel:
         wot.io.verbose("Using", self.max_threads, "thread(s) at most")
         if self.max_threads > 1:
             wot.io.verbose("Warning : Multiple threads are being used. Time estimates will be inaccurate")
+            if threadpool_limits is None:
+                print("Warning : threadpoolctl is not installed, the BLAS threads of each transport map cannot be "
+                      "limited and will oversubscribe the cores. Install it with pip install wot[parallel]")
 
         self.ot_config = {'local_pca': 30, 'growth_iters': 3, 'scaling_iter': 3000, 'inner_iter_max': 50,
-                          'epsilon': 0.05, 'lambda1': 1, 'lambda2': 50, 'epsilon0': 1, 'tau': 10000}
+                          'epsilon': 0.05, 'lambda1': 1, 'lambda2': 50, 'epsilon0': 1, 'tau': 10000,
+                          'precision': 'float64', 'solver': 'stable'}
 
         for k in kwargs.keys():
             self.ot_config[k] = kwargs[k]
@@ -149,6 +206,8 @@ class OTModel:
             print("Warning : local_pca set to {}, above gene count of {}. Disabling PCA" \
                   .format(local_pca, self.matrix.X.shape[1]))
             self.ot_config['local_pca'] = 0
+        self.embeddings = wot.ot.EmbeddingCache(self.tmap_dir if cache_pca else None, self.tmap_prefix,
+                                                self.matrix if global_pca else None)
         if 'day' not in self.matrix.obs.columns:
             raise ValueError("Days information not available for matrix")
         if any(self.matrix.obs['day'].isnull()):
@@ -179,6 +238,15 @@ class OTModel:
         -------
         None
             Only computes and saves all transport maps, does not return them.
+
+        Notes
+        -----
+        With trace_stride in the configuration, the solver traces of all day pairs are summarized
+        in {prefix}_solver_summary.txt, see summarize_solver_traces.
+        With a shard, only every N-th day pair is computed, and summarized in {prefix}_shard{i}_solver_summary.txt.
+        With work_queue, day pairs claimed by another process are skipped and reported at the end,
+        and covariate-restricted transport maps are not batched.
+        Existing transport maps are only computed again if their fingerprint changed, see get_transport_map_fingerprint.
         """
         t = self.timepoints
         day_pairs = self.day_pairs
@@ -205,12 +273,191 @@ class OTModel:
             print('No day pairs')
             return
 
+        self.prepare_global_pca()
+        all_day_pairs = day_pairs
+        if self.shard is not None:
+            day_pairs = day_pairs[self.shard[0]::self.shard[1]]
+        shard_day_pairs = day_pairs
+        if with_covariates and not self.work_queue:
+            day_pairs = self.compute_transport_map_batches(day_pairs)
+
         if m > 1:
-            from joblib import Parallel, delayed
-            Parallel(n_jobs=m)(delayed(self.compute_transport_map)(*x) for x in day_pairs)
+            self.map_in_workers('compute_transport_map', day_pairs, return_results=False,
+                                costs=[self.estimate_transport_map_cost(*x) for x in day_pairs],
+                                blas_threads=[self.estimate_blas_threads(*x) for x in day_pairs])
         else:
             for x in day_pairs:
                 self.compute_transport_map(*x)
+        if self.work_queue:
+            claimed = [x for x in shard_day_pairs if self.is_transport_map_claimed(*x)]
+            if claimed:
+                print("Warning : {} transport map(s) claimed by other processes were not computed : {}"
+                      .format(len(claimed), ', '.join(self.get_transport_map_path(*x) for x in claimed)))
+        if self.ot_config.get('trace_stride') is not None:
+            self.summarize_solver_traces(shard_day_pairs if self.shard is not None else all_day_pairs)
+
+    def map_in_workers(self, method, args, return_results=True, costs=None, blas_threads=None):
+        """
+        Calls a method of this model for each tuple of arguments, in at most max_threads worker processes.
+
+        The expression matrix is saved once to memory-mapped files that all workers share, see wot.ot.SharedMatrix.
+        Each worker receives a copy of the model without the matrix when it starts, then only the arguments
+        of each call.
+
+        Parameters
+        ----------
+        method : str
+            Name of the method, such as 'compute_transport_map'
+        args : list of tuple
+            Arguments of each call
+        return_results : bool, optional
+            Send the results back from the workers. Transport maps are already saved by compute_transport_map
+        costs : list of (float, float), optional
+            Estimated work and memory in bytes of each call, see estimate_transport_map_cost.
+            Calls are then started by decreasing work, so that the longest ones do not finish last,
+            and only while the memory of the running calls fits in max_memory.
+        blas_threads : list of int, optional
+            Number of BLAS threads of each call, see estimate_blas_threads. Calls only start while the
+            BLAS threads of the running calls add up to at most max_threads. One thread per call by default.
+            Requires threadpoolctl to limit the BLAS threads of each call.
+
+        Returns
+        -------
+        list
+            The result of each call, or None if return_results is False
+        """
+        if len(args) == 0:
+            return [] if return_results else None
+        order = list(range(len(args)))
+        memory = [0] * len(args)
+        budget = np.inf
+        n_workers = min(self.max_threads, len(args))
+        if costs is not None:
+            order.sort(key=lambda i: -costs[i][0])
+            memory = [cost[1] for cost in costs]
+            if self.max_memory is not None:
+                budget = self.max_memory * 2 ** 30
+                # As many workers as the smallest calls that fit in the budget together
+                n_fit = int(np.sum(np.cumsum(sorted(memory)) <= budget))
+                n_workers = max(1, min(n_workers, n_fit))
+                if max(memory) > budget:
+                    wot.io.verbose("Warning : some transport maps need more than max_memory, they are computed alone")
+        if blas_threads is None:
+            blas_threads = [1] * len(args)
+        wot.io.verbose("Using", n_workers, "worker(s) and", self.max_threads, "thread(s)")
+
+        model = copy.copy(self)
+        model.matrix = None
+        model.embeddings = copy.copy(self.embeddings)
+        global_pca = self.embeddings.matrix is not None
+        model.embeddings.matrix = None
+        results = [None] * len(args)
+        with wot.ot.SharedMatrix(self.matrix) as shared, \
+                concurrent.futures.ProcessPoolExecutor(n_workers, initializer=_initialize_worker,
+                                                       initargs=(model, shared, global_pca)) as executor:
+            running = {}
+            used = 0
+            used_threads = 0
+            while len(order) > 0 or len(running) > 0:
+                # Start the longest calls that fit, smaller ones fill the remaining memory and threads
+                for i in list(order):
+                    if len(running) == 0 or (len(running) < n_workers and used + memory[i] <= budget and
+                                             used_threads + blas_threads[i] <= self.max_threads):
+                        wot.io.verbose("Starting {} {} with {} BLAS thread(s)".format(method, args[i][:2],
+                                                                                      blas_threads[i]))
+                        running[executor.submit(_call_worker, method, args[i], return_results,
+                                                blas_threads[i])] = i
+                        used += memory[i]
+                        used_threads += blas_threads[i]
+                        order.remove(i)
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    used -= memory[i]
+                    used_threads -= blas_threads[i]
+                    results[i] = future.result()
+        return results if return_results else None
+
+    def estimate_transport_map_cost(self, t0, t1, covariate=None):
+        """
+        Estimates the work and the peak memory of the transport map from time t0 to time t1.
+
+        Both are proportional to the number of entries of the matrices the solver works on, n0 * n1 for the
+        default cost matrix, and depend on the solver, the precision, coresets, landmarks and nearest neighbors.
+
+        Parameters
+        ----------
+        t0 : float
+            Source timepoint for the transport map
+        t1 : float
+            Destination timepoint for the transport map
+        covariate : None or (int, int)
+            The covariate restriction on cells from t0 and t1
+
+        Returns
+        -------
+        work : float
+            Upper bound of the number of kernel entries updated by the scaling iterations
+        memory : float
+            Estimated peak memory in bytes
+        """
+        config = {**self.ot_config, **self.get_local_config(t0, t1)}
+        obs = self.matrix.obs
+        sizes = []
+        for t, c in zip((t0, t1), covariate if covariate is not None else (None, None)):
+            query = obs['day'] == float(t)
+            if c is not None:
+                query &= obs['covariate'] == c
+            sizes.append(int(query.sum()))
+        n0, n1 = sizes
+        itemsize = np.dtype(config.get('precision', 'float64')).itemsize
+        iterations = OTModel.get_scaling_iterations(config)
+        # Entries of the cost matrix and kernel, and number of matrices held at once besides the transport map
+        if config.get('coreset') is not None:
+            entries = min(config['coreset'], n0) * min(config['coreset'], n1)
+            matrices = 2
+        elif config.get('knn') is not None:
+            entries = 2 * (n0 + n1) * config['knn']
+            matrices = 3
+        elif config.get('solver') == 'nystrom':
+            entries = 2 * (n0 + n1) * (config.get('landmarks') or 200)
+            matrices = 2
+        else:
+            entries = n0 * n1
+            matrices = 2 if config.get('solver') != 'sparse' else 3
+            # A memory-mapped cost matrix is not held in memory
+            if config.get('cost_matrix_dir') is not None:
+                matrices -= 1
+        # The dense transport map is a separate matrix unless it is the scaled kernel
+        tmap_entries = 0 if config.get('knn') is not None or entries == n0 * n1 \
+                            or (config.get('solver') == 'nystrom' and config.get('nystrom_factors')) else n0 * n1
+        return float(entries) * iterations, float(matrices * entries + tmap_entries) * itemsize
+
+    def estimate_blas_threads(self, t0, t1, covariate=None):
+        """
+        Chooses the number of BLAS threads for the transport map from time t0 to time t1.
+
+        Large kernels get one thread per BLAS_ENTRIES_PER_THREAD entries, up to max_threads,
+        small ones a single thread, so that more of them are computed at once instead.
+
+        Returns
+        -------
+        int
+            The number of BLAS threads
+        """
+        config = {**self.ot_config, **self.get_local_config(t0, t1)}
+        entries = self.estimate_transport_map_cost(t0, t1, covariate)[0] / OTModel.get_scaling_iterations(config)
+        return int(min(self.max_threads, max(1, entries // OTModel.BLAS_ENTRIES_PER_THREAD)))
+
+    @staticmethod
+    def get_scaling_iterations(config):
+        """Maximum number of scaling iterations of a transport map, over all growth iterations"""
+        return config.get('growth_iters', 3) * (config.get('scaling_iter', 3000) + 1000)
+
+    def prepare_global_pca(self):
+        """Computes the global PCA once, if enabled, before day pairs are dispatched to workers"""
+        if self.embeddings.matrix is not None and self.ot_config['local_pca'] > 0:
+            self.embeddings.get_global_pca(self.ot_config['local_pca'])
 
     def compute_transport_map(self, t0, t1, covariate=None):
         """
@@ -228,57 +475,913 @@ class OTModel:
         Returns
         -------
         anndata.AnnData
-            The transport map from t0 to t1
+            The transport map from t0 to t1.
+            None with work_queue if another process is computing it.
+
+        Notes
+        -----
+        An existing transport map is returned as is, unless force is set or the fingerprint recorded
+        in {prefix}_manifest.json differs, meaning that its cells, genes or configuration changed.
 
         Raises
         ------
         ValueError
             If the OTModel was initialized with day_pairs and the given pair is not present.
         """
-        path = self.tmap_prefix
         wot.io.verbose("Computing tmap ({},{})".format(t0, t1))
+        local_config = self.get_local_config(t0, t1)
+        path = self.get_transport_map_path(t0, t1, covariate)
+        output_file = wot.io.check_file_extension(os.path.join(self.tmap_dir, path), self.output_file_format)
+        lock_file = OTModel.claim_transport_map(output_file, self.lock_timeout) if self.work_queue else None
+        if self.work_queue and lock_file is None:
+            wot.io.verbose('Tmap ' + output_file + ' is claimed by another process')
+            return None
+        try:
+            # Checked after claiming, another process may have just finished it
+            fingerprint = self.get_transport_map_fingerprint(t0, t1, covariate)
+            if self.is_transport_map_current(path, output_file, fingerprint):
+                wot.io.verbose('Found existing tmap at ' + output_file + '. Use --force to overwrite.')
+                return wot.io.read_dataset(output_file)
+
+            config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
+            if self.warm_start and os.path.exists(output_file):
+                config['previous_tmap'] = wot.io.read_dataset(output_file)
+            tmap = OTModel.compute_single_transport_map(self.matrix, config, self.embeddings)
+            if tmap is not None:
+                OTModel.write_transport_map(tmap, output_file, self.output_file_format)
+                self.update_manifest({path: fingerprint})
+                wot.io.verbose("Created tmap ({}, {}) : {}".format(t0, t1, path))
+                trace = wot.ot.get_solver_trace(tmap)
+                if trace is not None:
+                    trace.to_json(os.path.join(self.tmap_dir, path + '_trace.json'), orient='records')
+            return tmap
+        finally:
+            if lock_file is not None:
+                os.remove(lock_file)
+
+    def get_transport_map_fingerprint(self, t0, t1, covariate=None):
+        """
+        Computes a hash of the inputs of a transport map : the ids, expression values and growth rates of its cells,
+        the gene ids, and its configuration, except UNFINGERPRINTED_PARAMETERS.
+        With a global PCA, the whole matrix is part of the inputs of every transport map.
+
+        Returns
+        -------
+        str
+            The hexadecimal sha1 hash
+        """
+        config = {**self.ot_config, **self.get_local_config(t0, t1), 't0': t0, 't1': t1, 'covariate': covariate}
+        key = repr(sorted((k, v) for k, v in config.items() if k not in OTModel.UNFINGERPRINTED_PARAMETERS))
+        if self.embeddings.matrix is not None and config['local_pca'] > 0:
+            key += self.embeddings.get_fingerprint(self.embeddings.matrix)
+        obs = self.matrix.obs
+        datasets = []
+        for t, c in ((t0, 0), (t1, 1)):
+            query = obs['day'] == float(t)
+            if covariate is not None:
+                query &= obs['covariate'] == covariate[c]
+            datasets.append(self.matrix[query.values])
+        return wot.ot.EmbeddingCache.fingerprint(key, *datasets, obs_columns=('cell_growth_rate', 'pp'))
+
+    def is_transport_map_current(self, path, output_file, fingerprint):
+        """
+        Whether an existing transport map can be used as is.
+
+        Transport maps missing from the manifest, written before it was introduced, are assumed to be current.
+        """
+        if self.force or not os.path.exists(output_file):
+            return False
+        recorded = self.read_manifest().get(path)
+        if recorded is not None and recorded != fingerprint:
+            wot.io.verbose('Inputs of tmap ' + output_file + ' changed since it was computed')
+            return False
+        return True
+
+    def read_manifest(self):
+        """Reads the fingerprints of the transport maps recorded in {prefix}_manifest.json, by path"""
+        manifest_file = os.path.join(self.tmap_dir, self.tmap_prefix + '_manifest.json')
+        if not os.path.exists(manifest_file):
+            return {}
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    def update_manifest(self, fingerprints):
+        """
+        Records the fingerprints of transport maps in {prefix}_manifest.json.
+
+        The manifest is locked while it is updated, as transport maps may be written by several processes.
+        A lock older than MANIFEST_LOCK_TIMEOUT seconds is assumed to be left by a crashed process and reclaimed.
+
+        Parameters
+        ----------
+        fingerprints : dict
+            The fingerprint of each transport map, by path relative to the transport map directory
+        """
+        OTModel.update_manifest_file(os.path.join(self.tmap_dir, self.tmap_prefix + '_manifest.json'), fingerprints)
+
+    @staticmethod
+    def update_manifest_file(manifest_file, fingerprints):
+        """Records the fingerprints of transport maps in a manifest file, see update_manifest"""
+        lock_file = OTModel.claim_transport_map(manifest_file, OTModel.MANIFEST_LOCK_TIMEOUT)
+        while lock_file is None:
+            time.sleep(0.01)
+            lock_file = OTModel.claim_transport_map(manifest_file, OTModel.MANIFEST_LOCK_TIMEOUT)
+        try:
+            manifest = {}
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+            manifest.update(fingerprints)
+            directory, name = os.path.split(manifest_file)
+            tmp_file = os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+            with open(tmp_file, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, manifest_file)
+        finally:
+            os.remove(lock_file)
+
+    def is_transport_map_claimed(self, t0, t1, covariate=None):
+        """Whether a transport map is missing and locked by another process, see claim_transport_map"""
+        output_file = wot.io.check_file_extension(
+            os.path.join(self.tmap_dir, self.get_transport_map_path(t0, t1, covariate)), self.output_file_format)
+        directory, name = os.path.split(output_file)
+        return not os.path.exists(output_file) and os.path.exists(os.path.join(directory, '.{}.lock'.format(name)))
+
+    @staticmethod
+    def claim_transport_map(output_file, timeout=None):
+        """
+        Claims a transport map by creating a lock file next to it, .{name}.lock.
+
+        Creating the file fails if it already exists, also on shared filesystems such as NFS,
+        so only one process claims each transport map. The lock file records the host, process id and time.
+        A lock is reclaimed if its process is no longer running on this host, or if it is older than timeout.
+
+        Parameters
+        ----------
+        output_file : str
+            The transport map file
+        timeout : float, optional
+            Seconds after which a lock is reclaimed, whichever host holds it. Never by default
+
+        Returns
+        -------
+        str
+            The lock file, to delete once the transport map is written. None if it is already claimed.
+        """
+        directory, name = os.path.split(output_file)
+        lock_file = os.path.join(directory, '.{}.lock'.format(name))
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not OTModel.is_stale_lock(lock_file, timeout):
+                return None
+            # Only one process renames the stale lock away. If it turns out to be a new lock,
+            # created by another process reclaiming it in the meantime, it is given back.
+            stale_file = '{}.{}.stale'.format(lock_file, os.getpid())
+            try:
+                os.rename(lock_file, stale_file)
+            except FileNotFoundError:
+                return None
+            if not OTModel.is_stale_lock(stale_file, timeout):
+                os.rename(stale_file, lock_file)
+                return None
+            os.remove(stale_file)
+            wot.io.verbose('Reclaimed stale lock ' + lock_file)
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return None
+        with os.fdopen(fd, 'w') as f:
+            f.write('{} {} {}\n'.format(socket.gethostname(), os.getpid(), time.time()))
+        return lock_file
+
+    @staticmethod
+    def is_stale_lock(lock_file, timeout=None):
+        """
+        Whether a lock file created by claim_transport_map was left by a process that is no longer running
+        on this host, or is older than timeout seconds. Locks held on other hosts only expire with a timeout.
+        """
+        try:
+            with open(lock_file) as f:
+                fields = f.read().split()
+            modified = os.path.getmtime(lock_file)
+        except FileNotFoundError:
+            return False
+        if timeout is not None and time.time() - (float(fields[2]) if len(fields) == 3 else modified) > timeout:
+            return True
+        if len(fields) != 3 or fields[0] != socket.gethostname():
+            # Being written, or held on another host
+            return False
+        try:
+            os.kill(int(fields[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    @staticmethod
+    def write_transport_map(tmap, output_file, output_format):
+        """
+        Writes a transport map to a hidden temporary file in the same directory, then renames it to output_file.
+
+        The rename is atomic, so a process that crashes never leaves a partial transport map
+        that would be taken for a computed one.
+        """
+        directory, name = os.path.split(output_file)
+        tmp_file = os.path.join(directory, '.{}.{}.tmp{}'.format(name, os.getpid(), os.path.splitext(name)[1]))
+        try:
+            wot.io.write_dataset(tmap, tmp_file, output_format=output_format)
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def summarize_solver_traces(self, day_pairs):
+        """
+        Summarizes the solver traces saved with the transport maps of the given day pairs.
+
+        Parameters
+        ----------
+        day_pairs : list of tuple
+            (t0, t1) or (t0, t1, covariate) of each transport map.
+            Transport maps without a {path}_trace.json file, such as those computed in batches, are skipped
+
+        Returns
+        -------
+        summary : pandas.DataFrame
+            One row per transport map, see wot.ot.summarize_solver_trace.
+            It is also written to {prefix}_solver_summary.txt, or {prefix}_shard{i}_solver_summary.txt
+            with a shard so that shards do not overwrite each other's summaries
+        """
+        rows = []
+        for day_pair in day_pairs:
+            trace_file = os.path.join(self.tmap_dir, self.get_transport_map_path(*day_pair) + '_trace.json')
+            if os.path.exists(trace_file):
+                trace = pd.read_json(trace_file, orient='records')
+                covariate = day_pair[2] if len(day_pair) > 2 else None
+                rows.append({'t0': day_pair[0], 't1': day_pair[1], 'covariate': covariate,
+                             **wot.ot.summarize_solver_trace(trace)})
+        summary = pd.DataFrame(rows, columns=['t0', 't1', 'covariate', 'growth_iterations', 'iterations', 'epsilon',
+                                              'row_marginal_error', 'column_marginal_error', 'stabilizations',
+                                              'time'])
+        name = self.tmap_prefix + ('_shard{}'.format(self.shard[0]) if self.shard is not None else '') \
+               + '_solver_summary.txt'
+        # Written to a temporary file first, work queue processes write the summary of all day pairs found
+        tmp_file = os.path.join(self.tmap_dir, '.{}.{}.tmp'.format(name, os.getpid()))
+        summary.to_csv(tmp_file, sep='\t', index=False)
+        os.replace(tmp_file, os.path.join(self.tmap_dir, name))
+        return summary
+
+    def get_local_config(self, t0, t1):
+        """
+        Get the configuration specific to the transport map from t0 to t1.
+
+        Raises
+        ------
+        ValueError
+            If the OTModel was initialized with day_pairs and the given pair is not present.
+        """
         # If day_pairs is not None, its configuration takes precedence
         if self.day_pairs is not None:
             if (t0, t1) not in self.day_pairs:
                 raise ValueError("Transport map ({},{}) is not present in day_pairs".format(t0, t1))
-            local_config = self.day_pairs[(t0, t1)]
-        else:
-            local_config = {}
+            return self.day_pairs[(t0, t1)]
+        return {}
 
+    def get_transport_map_path(self, t0, t1, covariate=None):
+        """Get the path of a transport map relative to the transport map directory, without extension"""
         if covariate is None:
-            path += "_{}_{}".format(t0, t1)
+            return self.tmap_prefix + "_{}_{}".format(t0, t1)
+        return self.tmap_prefix + "_{}_{}_cv{}_cv{}".format(t0, t1, *covariate)
+
+    def compute_transport_map_batches(self, day_pairs):
+        """
+        Computes small covariate-restricted transport maps in batches.
+
+        Transport maps sharing the same configuration are padded to the same size and solved
+        together with wot.ot.transport_stable_learn_growth_batch, then saved individually.
+
+        Parameters
+        ----------
+        day_pairs : list of (float, float, (int, int))
+            The source timepoint, destination timepoint and covariate restriction of each transport map
+
+        Returns
+        -------
+        list of (float, float, (int, int))
+            The transport maps left to compute individually : the existing ones, the larger ones
+            and those that do not use the 'stable' solver.
+        """
+        remaining = []
+        groups = {}
+        fingerprints = {}
+        for t0, t1, covariate in day_pairs:
+            path = self.get_transport_map_path(t0, t1, covariate)
+            output_file = wot.io.check_file_extension(os.path.join(self.tmap_dir, path), self.output_file_format)
+            fingerprint = self.get_transport_map_fingerprint(t0, t1, covariate)
+            config = {**self.ot_config, **self.get_local_config(t0, t1), 't0': t0, 't1': t1, 'covariate': covariate}
+            obs = self.matrix.obs
+            n = np.sum((obs['day'] == float(t0)) & (obs['covariate'] == covariate[0]))
+            m = np.sum((obs['day'] == float(t1)) & (obs['covariate'] == covariate[1]))
+            if self.is_transport_map_current(path, output_file, fingerprint) or n * m == 0 \
+                    or 2 * n * m > OTModel.MAX_BATCH_ELEMENTS \
+                    or config.get('solver', 'stable') != 'stable' or config.get('knn') is not None \
+                    or config.get('multiscale') is not None or config.get('coreset') is not None:
+                remaining.append((t0, t1, covariate))
+                continue
+            if self.warm_start and os.path.exists(output_file):
+                config['previous_tmap'] = wot.io.read_dataset(output_file)
+            previous_tmap = config.pop('previous_tmap', None)
+            C, p0, p1 = OTModel.prepare_transport_problem(self.matrix, config, self.embeddings)
+            cost_geometry = config.pop('cost_geometry', None)
+            if previous_tmap is not None:
+                config['duals'] = wot.ot.get_duals(previous_tmap, p0.obs.index, p1.obs.index)
+            for key in ['pp', 'qq', 'solver', 'kernel_threshold', 'trace_stride']:
+                config.pop(key, None)
+            key = repr(sorted((k, v) for k, v in config.items() if k not in ('g', 'duals')))
+            groups.setdefault(key, []).append((output_file, C, p0, p1, config, cost_geometry))
+            fingerprints[path] = fingerprint
+
+        batches = []
+        for problems in groups.values():
+            problems.sort(key=lambda problem: problem[1].shape)
+            batch = []
+            for problem in problems:
+                rows = max([problem[1].shape[0]] + [x[1].shape[0] for x in batch])
+                columns = max([problem[1].shape[1]] + [x[1].shape[1] for x in batch])
+                if len(batch) > 0 and (len(batch) + 1) * rows * columns > OTModel.MAX_BATCH_ELEMENTS:
+                    batches.append(batch)
+                    batch = []
+                batch.append(problem)
+            batches.append(batch)
+
+        if self.max_threads > 1:
+            from joblib import Parallel, delayed
+            Parallel(n_jobs=self.max_threads)(delayed(OTModel.solve_transport_map_batch)(batch, self.output_file_format)
+                                              for batch in batches)
         else:
-            path += "_{}_{}_cv{}_cv{}".format(t0, t1, *covariate)
-        output_file = os.path.join(self.tmap_dir, path)
-        output_file = wot.io.check_file_extension(output_file, self.output_file_format)
-        if os.path.exists(output_file) and not self.force:
-            wot.io.verbose('Found existing tmap at ' + output_file + '. Use --force to overwrite.')
-            return wot.io.read_dataset(output_file)
-
-        config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
-        tmap = OTModel.compute_single_transport_map(self.matrix, config)
-        if tmap is not None:
-            wot.io.write_dataset(tmap, output_file, output_format=self.output_file_format)
-            wot.io.verbose("Created tmap ({}, {}) : {}".format(t0, t1, path))
-        return tmap
+            for batch in batches:
+                OTModel.solve_transport_map_batch(batch, self.output_file_format)
+        if fingerprints:
+            self.update_manifest(fingerprints)
+        return remaining
 
     @staticmethod
-    def compute_default_cost_matrix(a, b, eigenvals=None):
+    def solve_transport_map_batch(batch, output_file_format):
+        """
+        Solves and saves a batch of transport maps sharing the same configuration.
+
+        Parameters
+        ----------
+        batch : list of (str, 2-D array, anndata.AnnData, anndata.AnnData, dict, dict)
+            For each transport map, the output file, the cost matrix, the source and destination cells,
+            the configuration of the solver and the cost geometry, as prepared by prepare_transport_problem
+        output_file_format : str
+            Format of the transport map files
+        """
+        wot.io.verbose("Computing {} tmaps in a batch".format(len(batch)))
+        config = {k: v for k, v in batch[0][4].items() if k not in ('g', 'duals')}
+        tmaps, duals = wot.ot.transport_stable_learn_growth_batch([problem[1] for problem in batch],
+                                                                  gs=[problem[4]['g'] for problem in batch],
+                                                                  duals=[problem[4].get('duals') for problem in batch],
+                                                                  log=True, **config)
+        for (output_file, C, p0, p1, _, cost_geometry), X, d in zip(batch, tmaps, duals):
+            tmap = anndata.AnnData(X, p0.obs.copy(), p1.obs.copy())
+            wot.ot.set_duals(tmap, d)
+            if cost_geometry is not None:
+                wot.ot.set_cost_geometry(tmap, cost_geometry)
+            OTModel.write_transport_map(tmap, output_file, output_file_format)
+            wot.io.verbose("Created tmap : {}".format(output_file))
+
+    def sweep(self, param_grid):
+        """
+        Computes the transport maps of all day pairs for every combination of parameters in a grid.
+
+        PCA and the cost matrix are only computed once per day pair. Grid points are then solved
+        in order of proximity, each one starting from the dual variables of its nearest solved neighbor.
+
+        Parameters
+        ----------
+        param_grid : dict of str to list
+            Values to try for 'epsilon', 'lambda1' and 'lambda2'.
+            Parameters not in the grid keep their configured value.
+
+        Returns
+        -------
+        summary : pandas.DataFrame
+            One row per day pair and grid point, with the solve time, the number of scaling iterations
+            and the relative marginal errors of the transport map.
+            It is also written to {prefix}_sweep_summary.txt
+
+        Notes
+        -----
+        The transport maps of a grid point are written with prefix {prefix}_epsilon-{epsilon}_lambda1-{lambda1}...
+        Warm starts only save scaling iterations when a tolerance is set in the configuration.
+        """
+        names = [name for name in OTModel.SWEEP_PARAMETERS if name in param_grid]
+        unknown = set(param_grid) - set(names)
+        if len(unknown) > 0:
+            raise ValueError("Unable to sweep parameters : {}".format(', '.join(sorted(unknown))))
+        grid = [dict(zip(names, values)) for values in itertools.product(*[param_grid[name] for name in names])]
+        order = OTModel.get_sweep_order(grid)
+
+        t = self.timepoints
+        day_pairs = self.day_pairs
+        if day_pairs is None or len(day_pairs) == 0:
+            day_pairs = [(t[i], t[i + 1]) for i in range(len(t) - 1)]
+
+        self.prepare_global_pca()
+        if self.max_threads > 1:
+            results = self.map_in_workers('sweep_day_pair', [(t0, t1, grid, order) for t0, t1 in day_pairs],
+                                          costs=[self.estimate_transport_map_cost(t0, t1) for t0, t1 in day_pairs],
+                                          blas_threads=[self.estimate_blas_threads(t0, t1) for t0, t1 in day_pairs])
+        else:
+            results = [self.sweep_day_pair(t0, t1, grid, order) for t0, t1 in day_pairs]
+
+        summary = pd.DataFrame([row for rows in results for row in rows],
+                               columns=['t0', 't1', *names, 'time', 'iterations', 'row_marginal_error',
+                                        'column_marginal_error'])
+        summary.to_csv(os.path.join(self.tmap_dir, self.tmap_prefix + '_sweep_summary.txt'), sep='\t', index=False)
+        return summary
+
+    def sweep_day_pair(self, t0, t1, grid, order):
+        """
+        Computes the transport maps from time t0 to time t1 for every point of a parameter grid.
+
+        Parameters
+        ----------
+        t0 : float
+            Source timepoint for the transport maps
+        t1 : float
+            Destination timepoint for the transport maps
+        grid : list of dict
+            The parameters of each grid point
+        order : list of (int, int)
+            Index of each grid point to solve, and index of the grid point to warm-start it from, see get_sweep_order
+
+        Returns
+        -------
+        list of dict
+            The summary row of each grid point
+        """
+        wot.io.verbose("Sweeping tmap ({},{})".format(t0, t1))
+        config = {**self.ot_config, **self.get_local_config(t0, t1), 't0': t0, 't1': t1}
+        problem = OTModel.prepare_transport_problem(self.matrix, config, self.embeddings)
+        if problem is None:
+            return []
+        C, p0, p1 = problem
+        coreset_labels = config.pop('coreset_labels', None)
+        cost_geometry = config.pop('cost_geometry', None)
+        densify = not config.pop('nystrom_factors', False)
+        g = config['g'] if coreset_labels is None else config['g'][coreset_labels[0]]
+
+        summary = []
+        solved_duals = {}
+        for index, warm_index in order:
+            point = grid[index]
+            path = self.tmap_prefix + ''.join('_{}-{}'.format(name, value) for name, value in point.items())
+            path += '_{}_{}'.format(t0, t1)
+            output_file = wot.io.check_file_extension(os.path.join(self.tmap_dir, path), self.output_file_format)
+            if os.path.exists(output_file) and not self.force:
+                wot.io.verbose('Found existing tmap at ' + output_file + '. Use --force to overwrite.')
+                tmap = wot.io.read_dataset(output_file)
+                duals = wot.ot.get_duals(tmap, p0.obs.index, p1.obs.index)
+                if coreset_labels is not None:
+                    duals = OTModel.compress_duals(duals, *coreset_labels)
+                elapsed, n_iter = np.nan, np.nan
+            else:
+                point_config = {**config, **point}
+                if warm_index is not None:
+                    point_config['duals'] = solved_duals[warm_index]
+                start = time.time()
+                X, duals = wot.ot.transport_stable_learn_growth(C, log=True, **point_config)
+                elapsed, n_iter = time.time() - start, duals['n_iter']
+                cell_duals = duals
+                if isinstance(X, wot.ot.LowRankMatrix):
+                    tmap = wot.ot.low_rank_transport_map(X, p0.obs.copy(), p1.obs.copy(), densify=densify)
+                else:
+                    if coreset_labels is not None:
+                        X, cell_duals = OTModel.lift_transport_map(X, duals, *coreset_labels)
+                    tmap = anndata.AnnData(X, p0.obs.copy(), p1.obs.copy())
+                wot.ot.set_duals(tmap, cell_duals)
+                if cost_geometry is not None:
+                    wot.ot.set_cost_geometry(tmap, cost_geometry)
+                if 'trace' in duals:
+                    wot.ot.set_solver_trace(tmap, duals['trace'])
+                OTModel.write_transport_map(tmap, output_file, self.output_file_format)
+                wot.io.verbose("Created tmap ({}, {}) : {} in {:.2f}s, {} iterations".format(t0, t1, path, elapsed,
+                                                                                             n_iter))
+            solved_duals[index] = duals
 
+            X = wot.ot.get_transport_matrix(tmap)
+            row_sums = np.asarray(X.sum(axis=1)).ravel() / tmap.shape[1]
+            column_sums = np.asarray(X.sum(axis=0)).ravel() / tmap.shape[0]
+            summary.append({'t0': t0, 't1': t1, **point, 'time': elapsed, 'iterations': n_iter,
+                            'row_marginal_error': np.sum(np.abs(row_sums - g)) / np.sum(g),
+                            'column_marginal_error': np.sum(np.abs(column_sums - np.average(g)))
+                                                     / (np.average(g) * len(column_sums))})
+        return summary
+
+    @staticmethod
+    def get_sweep_order(grid):
+        """
+        Orders the points of a parameter grid for warm starts.
+
+        Starting from the point with the largest epsilon, the next point to solve is always
+        the one closest to an already solved point, in log-parameter space.
+
+        Parameters
+        ----------
+        grid : list of dict
+            The parameters of each grid point. All values must be positive
+
+        Returns
+        -------
+        list of (int, int)
+            Index of each grid point to solve, and index of the solved grid point
+            to warm-start it from (None for the first one)
+        """
+        if len(grid) == 0:
+            return []
+        names = list(grid[0].keys())
+        coordinates = np.log([[float(point[name]) for name in names] for point in grid]).reshape(len(grid), -1)
+        distances = sklearn.metrics.pairwise.euclidean_distances(coordinates)
+        first = int(np.argmax(coordinates[:, names.index('epsilon')])) if 'epsilon' in names else 0
+
+        order = [(first, None)]
+        solved = np.zeros(len(grid), dtype=bool)
+        solved[first] = True
+        nearest_distance = distances[first].copy()
+        nearest_index = np.full(len(grid), first)
+        for _ in range(len(grid) - 1):
+            index = int(np.argmin(np.where(solved, np.inf, nearest_distance)))
+            order.append((index, int(nearest_index[index])))
+            solved[index] = True
+            closer = distances[index] < nearest_distance
+            nearest_distance[closer] = distances[index][closer]
+            nearest_index[closer] = index
+        return order
+
+    @staticmethod
+    def compute_default_cost_matrix(a, b, eigenvals=None, precision='float64', out=None, median_sample_size=None,
+                                    return_median=False):
+        """
+        Computes the squared euclidean distances between cells, divided by their median.
+
+        The matrix is built in row tiles directly in its final buffer, see wot.ot.squared_distances.
+        Sparse coordinates, such as the expression of all genes without local PCA, are not densified.
+
+        Parameters
+        ----------
+        a : 2-D array or sparse matrix
+            Coordinates of the source cells
+        b : 2-D array or sparse matrix
+            Coordinates of the destination cells
+        eigenvals : 2-D array, optional
+            Scaling applied to the coordinates
+        precision : str, optional
+            Floating point type of the cost matrix, 'float64' or 'float32'
+        out : 2-D array, optional
+            Buffer of that type for the cost matrix, such as a numpy.memmap to keep it out of memory
+        median_sample_size : int, optional
+            Estimate the median from this many random pairs of cells, see estimate_median_cost,
+            instead of computing it from the full matrix, which requires a copy of it
+        return_median : bool, optional
+            Also return the median the squared distances were divided by
+
+        Returns
+        -------
+        cost_matrix : 2-D array
+            The normalized cost matrix
+        median : float
+            The median, only returned with return_median
+        """
+        if eigenvals is not None:
+            a = a.dot(eigenvals)
+            b = b.dot(eigenvals)
+
+        dtype = np.dtype(precision)
+        if scipy.sparse.issparse(a) or scipy.sparse.issparse(b):
+            a, b = scipy.sparse.csr_matrix(a, dtype=dtype), scipy.sparse.csr_matrix(b, dtype=dtype)
+        else:
+            a, b = np.asarray(a, dtype=dtype), np.asarray(b, dtype=dtype)
+        cost_matrix = wot.ot.squared_distances(a, b, out=out)
+        if median_sample_size is None:
+            median = np.median(cost_matrix)
+        else:
+            median = OTModel.estimate_median_cost(a, b, median_sample_size)
+        cost_matrix /= median
+        return (cost_matrix, median) if return_median else cost_matrix
+
+    @staticmethod
+    def estimate_median_cost(a, b, sample_size=100000, seed=58951):
+        """
+        Estimates the median squared euclidean distance between the cells of a and b from random pairs of cells.
+
+        Parameters
+        ----------
+        a : 2-D array or sparse matrix
+            Coordinates of the source cells
+        b : 2-D array or sparse matrix
+            Coordinates of the destination cells
+        sample_size : int, optional
+            Maximum number of pairs of cells to sample
+        seed : int, optional
+            Seed of the random pairs, so that the estimate is deterministic
+
+        Returns
+        -------
+        median : float
+            The median squared distance of the sampled pairs
+        """
+        random_state = np.random.RandomState(seed)
+        sample_size = min(a.shape[0] * b.shape[0], sample_size)
+        i, j = random_state.randint(a.shape[0], size=sample_size), random_state.randint(b.shape[0], size=sample_size)
+        distances = np.empty(sample_size)
+        for start in range(0, sample_size, 10000):
+            pairs = slice(start, start + 10000)
+            difference = a[i[pairs]] - b[j[pairs]]
+            if scipy.sparse.issparse(difference):
+                distances[pairs] = np.asarray(difference.multiply(difference).sum(axis=1)).ravel()
+            else:
+                distances[pairs] = np.einsum('ij,ij->i', difference, difference)
+        return np.median(distances)
+
+    @staticmethod
+    def compute_landmark_cost(a, b, n_landmarks, eigenvals=None):
+        """
+        Computes the normalized squared euclidean cost for the nystrom solver, without computing the cost matrix.
+
+        The landmarks are the centers of k-means clusters of both timepoints together.
+
+        Parameters
+        ----------
+        a : 2-D array
+            Coordinates of the source cells
+        b : 2-D array
+            Coordinates of the destination cells
+        n_landmarks : int
+            Number of landmarks, the rank of the approximated kernel
+        eigenvals : 2-D array, optional
+            Diagonal matrix used to scale the coordinates
+
+        Returns
+        -------
+        cost : wot.ot.LandmarkCost
+            The cost, normalized like the default cost matrix
+        """
+        if eigenvals is not None:
+            a = a.dot(eigenvals)
+            b = b.dot(eigenvals)
+        a = a.toarray() if scipy.sparse.isspmatrix(a) else np.asarray(a)
+        b = b.toarray() if scipy.sparse.isspmatrix(b) else np.asarray(b)
+        scale = np.sqrt(OTModel.estimate_median_cost(a, b))
+        a, b = a / scale, b / scale
+        _, landmarks = OTModel.cluster_cells(np.vstack((a, b)), n_landmarks)
+        return wot.ot.LandmarkCost(a, b, landmarks)
+
+    @staticmethod
+    def compute_knn_cost_matrix(a, b, k, eigenvals=None, precision='float64'):
+        """
+        Computes a sparse cost matrix restricted to nearest neighbors.
+
+        Each cell of a keeps the cost to its k nearest neighbors in b, and each cell of b the
+        cost to its k nearest neighbors in a. Costs are normalized like the default cost matrix,
+        with the median estimated from random pairs of cells.
+
+        Parameters
+        ----------
+        a : 2-D array
+            Coordinates of the source cells
+        b : 2-D array
+            Coordinates of the destination cells
+        k : int
+            Number of neighbors to keep for each cell
+        eigenvals : 2-D array, optional
+            Diagonal matrix used to scale the coordinates
+        precision : str, optional
+            Floating point type of the result, 'float64' or 'float32'
+
+        Returns
+        -------
+        cost_matrix : scipy.sparse.csr_matrix
+            The normalized squared euclidean distances between neighbors
+        """
         if eigenvals is not None:
             a = a.dot(eigenvals)
             b = b.dot(eigenvals)
+        a = a.toarray() if scipy.sparse.isspmatrix(a) else np.asarray(a)
+        b = b.toarray() if scipy.sparse.isspmatrix(b) else np.asarray(b)
+        n, m = a.shape[0], b.shape[0]
+
+        distances, indices = sklearn.neighbors.NearestNeighbors(n_neighbors=min(k, m)).fit(b).kneighbors(a)
+        rows = [np.repeat(np.arange(n), indices.shape[1])]
+        cols = [indices.ravel()]
+        data = [distances.ravel()]
+        distances, indices = sklearn.neighbors.NearestNeighbors(n_neighbors=min(k, n)).fit(a).kneighbors(b)
+        rows.append(indices.ravel())
+        cols.append(np.repeat(np.arange(m), indices.shape[1]))
+        data.append(distances.ravel())
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data) ** 2
+        # Pairs found in both directions must only be stored once
+        _, unique = np.unique(rows * m + cols, return_index=True)
+        rows, cols, data = rows[unique], cols[unique], data[unique]
+
+        data = data / OTModel.estimate_median_cost(a, b)
+        return scipy.sparse.csr_matrix((data.astype(precision), (rows, cols)), shape=(n, m))
+
+    @staticmethod
+    def cluster_cells(x, n_clusters):
+        """
+        Groups cells with k-means.
+
+        Parameters
+        ----------
+        x : 2-D array
+            Coordinates of the cells
+        n_clusters : int
+            Maximum number of clusters. Each cell is its own cluster if there are fewer cells
+
+        Returns
+        -------
+        labels : 1-D array of int
+            The cluster of each cell. Clusters are numbered from 0 and none of them is empty
+        centers : 2-D array
+            The coordinates of the center of each cluster
+        """
+        if x.shape[0] <= n_clusters:
+            return np.arange(x.shape[0]), x
+        import sklearn.cluster
+        kmeans = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=0, n_init=3).fit(x)
+        clusters, labels = np.unique(kmeans.labels_, return_inverse=True)
+        return labels, kmeans.cluster_centers_[clusters]
+
+    @staticmethod
+    def compute_coreset_cost_matrix(a, b, size, config, eigenvals=None):
+        """
+        Computes the cost matrix between weighted representatives of the cells of each timepoint.
+
+        The representatives are the centers of k-means++ clusters, weighted by the fraction of cells
+        they represent. Costs are normalized by the median cost between cells, like the default cost matrix.
+
+        Parameters
+        ----------
+        a : 2-D array
+            Coordinates of the source cells
+        b : 2-D array
+            Coordinates of the destination cells
+        size : int
+            Number of representatives for each timepoint
+        config : dict
+            Configuration of the solver, with the growth rates g of the source cells.
+            It is updated in place : g is averaged over the cells of each representative, the weights
+            of the representatives are set as dx and dy, and the representative of each cell
+            as coreset_labels, see lift_transport_map
 
-        cost_matrix = sklearn.metrics.pairwise.pairwise_distances(a.toarray() if scipy.sparse.isspmatrix(a) else a,
-                                                                  b.toarray() if scipy.sparse.isspmatrix(b) else b,
-                                                                  metric='sqeuclidean')
-        cost_matrix = cost_matrix / np.median(cost_matrix)
+        Returns
+        -------
+        cost_matrix : 2-D array
+            The normalized squared euclidean distances between representatives
+        """
+        if eigenvals is not None:
+            a = a.dot(eigenvals)
+            b = b.dot(eigenvals)
+        a = a.toarray() if scipy.sparse.isspmatrix(a) else np.asarray(a)
+        b = b.toarray() if scipy.sparse.isspmatrix(b) else np.asarray(b)
+        labels0, centers0 = OTModel.cluster_cells(a, size)
+        labels1, centers1 = OTModel.cluster_cells(b, size)
+        sizes0 = np.bincount(labels0)
+        config['g'] = np.bincount(labels0, weights=config['g']) / sizes0
+        config['dx'] = sizes0 / a.shape[0]
+        config['dy'] = np.bincount(labels1) / b.shape[0]
+        config['coreset_labels'] = labels0, labels1
+        dtype = np.dtype(config.get('precision', 'float64'))
+        cost_matrix = sklearn.metrics.pairwise.euclidean_distances(np.asarray(centers0, dtype=dtype),
+                                                                   np.asarray(centers1, dtype=dtype), squared=True)
+        cost_matrix /= OTModel.estimate_median_cost(a, b)
         return cost_matrix
 
     @staticmethod
-    def compute_single_transport_map(ds, config):
+    def lift_transport_map(tmap, duals, labels0, labels1):
         """
-        Computes a single transport map.
+        Expands a transport map between representatives to every cell.
+
+        Each cell gets the row or column of its representative.
+
+        Parameters
+        ----------
+        tmap : 2-D array or scipy.sparse.csr_matrix
+            Transport map between representatives
+        duals : dict
+            The dual variables of the transport map between representatives
+        labels0 : 1-D array of int
+            The representative of each source cell
+        labels1 : 1-D array of int
+            The representative of each destination cell
+
+        Returns
+        -------
+        tmap : 2-D array or scipy.sparse.csr_matrix
+            The transport map between cells
+        duals : dict
+            The dual variables of each cell
+        """
+        duals = {**duals, 'u': duals['u'][labels0], 'a': duals['a'][labels0],
+                 'v': duals['v'][labels1], 'b': duals['b'][labels1]}
+        return tmap[labels0][:, labels1], duals
+
+    @staticmethod
+    def compress_duals(duals, labels0, labels1):
+        """
+        Averages the dual variables of the cells of each representative, the inverse of lift_transport_map.
+        """
+        if duals is None:
+            return None
+        sizes0, sizes1 = np.bincount(labels0), np.bincount(labels1)
+        return {**duals, 'u': np.bincount(labels0, weights=duals['u']) / sizes0,
+                'a': np.bincount(labels0, weights=duals['a']) / sizes0,
+                'v': np.bincount(labels1, weights=duals['v']) / sizes1,
+                'b': np.bincount(labels1, weights=duals['b']) / sizes1}
+
+    @staticmethod
+    def compute_multiscale_cost_matrix(a, b, n_clusters, config, eigenvals=None, threshold=1e-3):
+        """
+        Computes a sparse cost matrix restricted to the support of a coarse transport map.
+
+        Cells of each timepoint are grouped into clusters, and the transport map between cluster
+        centers is computed with the cluster sizes as weights. The cost between two cells is then
+        only kept if their clusters exchange a significant fraction of their mass.
+        The full cost matrix is never computed.
+
+        Parameters
+        ----------
+        a : 2-D array
+            Coordinates of the source cells
+        b : 2-D array
+            Coordinates of the destination cells
+        n_clusters : int
+            Number of clusters for each timepoint
+        config : dict
+            Configuration of the solver, with the growth rates g of the source cells.
+            The dual variables of the coarse transport map are stored in it as 'duals' to initialize
+            the solver, unless initial dual variables are already present.
+        eigenvals : 2-D array, optional
+            Diagonal matrix used to scale the coordinates
+        threshold : float, optional
+            Keep the pairs of clusters transporting at least this fraction of the mass of either cluster.
+            The largest destination of each source cluster and the largest source of each destination
+            cluster are always kept
+
+        Returns
+        -------
+        cost_matrix : scipy.sparse.csr_matrix
+            The normalized squared euclidean distances between cells of matching clusters
+        """
+        if eigenvals is not None:
+            a = a.dot(eigenvals)
+            b = b.dot(eigenvals)
+        a = a.toarray() if scipy.sparse.isspmatrix(a) else np.asarray(a)
+        b = b.toarray() if scipy.sparse.isspmatrix(b) else np.asarray(b)
+        labels0, centers0 = OTModel.cluster_cells(a, n_clusters)
+        labels1, centers1 = OTModel.cluster_cells(b, n_clusters)
+        sizes0 = np.bincount(labels0)
+        sizes1 = np.bincount(labels1)
+
+        median = OTModel.estimate_median_cost(a, b)
+
+        coarse_config = {**config, 'g': np.bincount(labels0, weights=config['g']) / sizes0, 'pp': None, 'qq': None,
+                         'duals': None, 'solver': 'stable', 'dx': sizes0 / a.shape[0], 'dy': sizes1 / b.shape[0]}
+        coarse_cost = sklearn.metrics.pairwise.euclidean_distances(centers0, centers1, squared=True) / median
+        coarse_tmap, coarse_duals = wot.ot.transport_stable_learn_growth(coarse_cost, log=True, **coarse_config)
+        if config.get('duals') is None:
+            u, v = wot.ot.absorb_duals(coarse_duals)
+            config['duals'] = {'u': u[labels0], 'v': v[labels1], 'a': np.ones(a.shape[0]),
+                               'b': np.ones(b.shape[0]), 'epsilon': coarse_duals['epsilon']}
+
+        mass = coarse_tmap * np.outer(coarse_config['dx'], coarse_config['dy'])
+        support = (mass >= threshold * mass.sum(axis=1, keepdims=True)) | \
+                  (mass >= threshold * mass.sum(axis=0, keepdims=True))
+        support[np.arange(mass.shape[0]), mass.argmax(axis=1)] = True
+        support[mass.argmax(axis=0), np.arange(mass.shape[1])] = True
+
+        members0 = np.split(np.argsort(labels0, kind='stable'), np.cumsum(sizes0)[:-1])
+        members1 = np.split(np.argsort(labels1, kind='stable'), np.cumsum(sizes1)[:-1])
+        rows, cols, data = [], [], []
+        for cluster0, cluster1 in zip(*np.nonzero(support)):
+            i, j = members0[cluster0], members1[cluster1]
+            rows.append(np.repeat(i, len(j)))
+            cols.append(np.tile(j, len(i)))
+            data.append(sklearn.metrics.pairwise.euclidean_distances(a[i], b[j], squared=True).ravel())
+        data = np.concatenate(data) / median
+        return scipy.sparse.csr_matrix((data.astype(config.get('precision', 'float64')),
+                                        (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=(a.shape[0], b.shape[0]))
+
+    @staticmethod
+    def prepare_transport_problem(ds, config, embeddings=None):
+        """
+        Selects the cells of a transport map and computes its cost matrix.
         Note that None is returned if no data is available at the specified timepoints or covariates.
 
         Parameters
@@ -287,9 +1390,25 @@ class OTModel:
             The gene expression matrix to consider.
             It is assumed to have a valid day column for each cell.
         config : dict
-            Configuration to use for all parameters for the couplings :
-            - t0, t1
-            - lambda1, lambda2, epsilon, g
+            Configuration of the transport map, see compute_single_transport_map.
+            It is updated in place : t0, t1, covariate, local_pca, knn, multiscale, multiscale_threshold,
+            landmarks, coreset, median_sample_size and cost_matrix_dir are consumed,
+            and the growth rates g, pp and qq are set for the solver.
+            With a coreset, the cost matrix is between representatives and their cells are given
+            as coreset_labels, to be removed before solving, see lift_transport_map.
+            With the default cost matrix, the embedding and scale of the costs are given as cost_geometry,
+            to be removed before solving, see wot.ot.set_cost_geometry.
+        embeddings : wot.ot.EmbeddingCache, optional
+            Cache of the local PCA coordinates
+
+        Returns
+        -------
+        C : 2-D array or scipy.sparse.csr_matrix
+            The cost matrix
+        p0 : anndata.AnnData
+            The source cells
+        p1 : anndata.AnnData
+            The destination cells
         """
         t0 = config.pop('t0', None)
         t1 = config.pop('t1', None)
@@ -322,16 +1441,133 @@ class OTModel:
             # pca, mean = wot.ot.get_pca(local_pca, p0.X, p1.X)
             # p0_x = wot.ot.pca_transform(pca, mean, p0.X)
             # p1_x = wot.ot.pca_transform(pca, mean, p1.X)
-            p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0.X, p1.X, local_pca)
+            if embeddings is not None:
+                p0_x, p1_x, pca, mean = embeddings.compute_pca(p0, p1, local_pca)
+            else:
+                p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0.X, p1.X, local_pca)
             eigenvals = np.diag(pca.singular_values_)
         else:
             p0_x = p0.X
             p1_x = p1.X
 
-        C = OTModel.compute_default_cost_matrix(p0_x, p1_x, eigenvals)
         if config.get('g') is None:
-            config['g'] = np.ones(C.shape[0])
+            config['g'] = np.ones(p0.shape[0])
         delta_days = t1 - t0
         config['g'] = config['g'] ** delta_days
-        tmap = wot.ot.transport_stable_learn_growth(C, **config)
-        return anndata.AnnData(tmap, p0.obs.copy(), p1.obs.copy())
+
+        knn = config.pop('knn', None)
+        multiscale = config.pop('multiscale', None)
+        multiscale_threshold = config.pop('multiscale_threshold', None)
+        landmarks = config.pop('landmarks', None)
+        coreset = config.pop('coreset', None)
+        median_sample_size = config.pop('median_sample_size', None)
+        cost_matrix_dir = config.pop('cost_matrix_dir', None)
+        if coreset is not None:
+            if knn is not None or multiscale is not None or config.get('solver') == 'nystrom':
+                raise ValueError("Coresets are only supported with the default cost matrix")
+            C = OTModel.compute_coreset_cost_matrix(p0_x, p1_x, coreset, config, eigenvals)
+        elif knn is not None:
+            if config.get('solver') != 'sparse':
+                raise ValueError("Nearest neighbors cost matrices require the sparse solver")
+            C = OTModel.compute_knn_cost_matrix(p0_x, p1_x, knn, eigenvals, precision=config.get('precision', 'float64'))
+        elif multiscale is not None:
+            if config.get('solver', 'stable') not in ('stable', 'accelerated', 'sparse'):
+                raise ValueError("Multiscale transport maps are not supported by the {} solver".format(config['solver']))
+            C = OTModel.compute_multiscale_cost_matrix(p0_x, p1_x, multiscale, config, eigenvals,
+                                                       threshold=multiscale_threshold
+                                                       if multiscale_threshold is not None else 1e-3)
+        elif config.get('solver') == 'nystrom':
+            C = OTModel.compute_landmark_cost(p0_x, p1_x, landmarks if landmarks is not None else 200, eigenvals)
+        else:
+            out = None
+            if cost_matrix_dir is not None:
+                # the file is removed when closed, its memory map keeps it until the cost matrix is released
+                with tempfile.TemporaryFile(dir=cost_matrix_dir) as f:
+                    out = np.memmap(f, dtype=config.get('precision', 'float64'), mode='w+',
+                                    shape=(p0_x.shape[0], p1_x.shape[0]))
+            C, median = OTModel.compute_default_cost_matrix(p0_x, p1_x, eigenvals,
+                                                            precision=config.get('precision', 'float64'), out=out,
+                                                            median_sample_size=median_sample_size, return_median=True)
+            config['cost_geometry'] = {'scale': median, 'genes': ds.var.index, 'pca': None}
+            if eigenvals is not None:
+                config['cost_geometry'].update({'pca': pca, 'mean_shift': mean, 'x0': p0_x.dot(eigenvals),
+                                                'x1': p1_x.dot(eigenvals)})
+        return C, p0, p1
+
+    @staticmethod
+    def compute_single_transport_map(ds, config, embeddings=None):
+        """
+        Computes a single transport map.
+        Note that None is returned if no data is available at the specified timepoints or covariates.
+
+        Parameters
+        ----------
+        ds : anndata.AnnData
+            The gene expression matrix to consider.
+            It is assumed to have a valid day column for each cell.
+        config : dict
+            Configuration to use for all parameters for the couplings :
+            - t0, t1
+            - lambda1, lambda2, epsilon, g
+            - previous_tmap, optional : a transport map for the same cells whose dual variables
+            are used to initialize the solver
+            - nystrom_factors, optional : with the nystrom solver, only store the low-rank factors
+            of the transport map instead of densifying it, see wot.ot.low_rank_transport_map
+        embeddings : wot.ot.EmbeddingCache, optional
+            Cache of the local PCA coordinates
+
+        Notes
+        -----
+        The final dual variables of the solver are stored with the transport map, see wot.ot.get_duals,
+        as well as its trace when trace_stride is set, see wot.ot.get_solver_trace.
+        With the default cost matrix, the embedding and scale of the costs are stored as well,
+        so that the transport map can be extended with new cells, see wot.ot.extend_transport_map
+        """
+        previous_tmap = config.pop('previous_tmap', None)
+        problem = OTModel.prepare_transport_problem(ds, config, embeddings)
+        if problem is None:
+            return None
+        C, p0, p1 = problem
+        coreset_labels = config.pop('coreset_labels', None)
+        cost_geometry = config.pop('cost_geometry', None)
+        densify = not config.pop('nystrom_factors', False)
+        if previous_tmap is not None:
+            config['duals'] = wot.ot.get_duals(previous_tmap, p0.obs.index, p1.obs.index)
+            if config['duals'] is None:
+                wot.io.verbose("No dual variables available for these cells. Solving from scratch")
+            elif coreset_labels is not None:
+                config['duals'] = OTModel.compress_duals(config['duals'], *coreset_labels)
+        tmap, duals = wot.ot.transport_stable_learn_growth(C, log=True, **config)
+        if isinstance(tmap, wot.ot.LowRankMatrix):
+            tmap = wot.ot.low_rank_transport_map(tmap, p0.obs.copy(), p1.obs.copy(), densify=densify)
+        else:
+            if coreset_labels is not None:
+                tmap, duals = OTModel.lift_transport_map(tmap, duals, *coreset_labels)
+            tmap = anndata.AnnData(tmap, p0.obs.copy(), p1.obs.copy())
+        wot.ot.set_duals(tmap, duals)
+        if cost_geometry is not None:
+            wot.ot.set_cost_geometry(tmap, cost_geometry)
+        if 'trace' in duals:
+            wot.ot.set_solver_trace(tmap, duals['trace'])
+        return tmap
+
+
+# The model of each worker process, see OTModel.map_in_workers
+_worker_model = None
+
+
+def _initialize_worker(model, shared, global_pca):
+    global _worker_model
+    model.matrix = shared.open()
+    if global_pca:
+        model.embeddings.matrix = model.matrix
+    _worker_model = model
+
+
+def _call_worker(method, args, return_result, blas_threads):
+    if threadpool_limits is None:
+        result = getattr(_worker_model, method)(*args)
+    else:
+        with threadpool_limits(limits=blas_threads, user_api='blas'):
+            result = getattr(_worker_model, method)(*args)
+    return result if return_result else None
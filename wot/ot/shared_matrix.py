@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import anndata
+import numpy as np
+import scipy.sparse
+
+
+class SharedMatrix:
+    """
+    Expression matrix saved once to memory-mapped files, so that worker processes can open it without copying it.
+
+    Pickling a SharedMatrix only transfers the file names and the cell and gene metadata. Every process that
+    calls open() maps the same files, whose pages are shared by the operating system.
+
+    Parameters
+    ----------
+    ds : anndata.AnnData
+        The expression matrix, dense or sparse
+    directory : str, optional
+        Directory for the temporary files. The default temporary directory if None
+
+    Notes
+    -----
+    The files are deleted by close(), or when leaving the with block.
+    """
+
+    def __init__(self, ds, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='wot_matrix_', dir=directory)
+        self.shape = ds.X.shape
+        self.sparse = scipy.sparse.issparse(ds.X)
+        self.obs = ds.obs
+        self.var = ds.var
+        if self.sparse:
+            X = ds.X.tocsr()
+            arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr}
+        else:
+            arrays = {'X': np.asarray(ds.X)}
+        for name, array in arrays.items():
+            np.save(os.path.join(self.directory, name + '.npy'), array)
+
+    def open(self):
+        """
+        Maps the matrix into memory.
+
+        Returns
+        -------
+        ds : anndata.AnnData
+            The expression matrix, backed by read-only memory-mapped arrays
+        """
+
+        def load(name):
+            return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+        if self.sparse:
+            X = scipy.sparse.csr_matrix((load('data'), load('indices'), load('indptr')), shape=self.shape, copy=False)
+        else:
+            X = load('X')
+        return anndata.AnnData(X, self.obs, self.var)
+
+    def close(self):
+        """Deletes the files"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
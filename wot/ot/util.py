@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import anndata
 import numpy as np
 import ot as pot
+import pandas as pd
 import scipy.sparse
+import scipy.special
 import sklearn.metrics
 
+import wot.ot
+
 
 def compute_growth_scores(proliferation, apoptosis, beta_max=1.7, beta_center=0.25, delta_max=1.7, delta_min=0.3,
                           beta_min=0.3):
@@ -257,3 +262,303 @@ def earth_mover_distance(cloud1, cloud2, eigenvals):
     pairwise_dist = sklearn.metrics.pairwise.pairwise_distances(
         cloud1, Y=cloud2, metric='sqeuclidean')
     return np.sqrt(pot.emd2(p, q, pairwise_dist, numItermax=1e7))
+
+
+def set_duals(tmap, duals):
+    """
+    Store the dual variables of the OT solver with a transport map
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map. Dual variables are stored in obs, var and uns, and are only kept by the h5ad format.
+    duals : dict
+        The dual variables 'u', 'v', 'a', 'b' and 'epsilon', as returned by the solvers with log=True
+    """
+    tmap.obs['ot_u'] = np.asarray(duals['u'], dtype=np.float64)
+    tmap.obs['ot_a'] = np.asarray(duals['a'], dtype=np.float64)
+    tmap.var['ot_v'] = np.asarray(duals['v'], dtype=np.float64)
+    tmap.var['ot_b'] = np.asarray(duals['b'], dtype=np.float64)
+    tmap.uns['ot_epsilon'] = float(duals['epsilon'])
+
+
+def get_duals(tmap, obs_index=None, var_index=None):
+    """
+    Retrieve the dual variables stored with a transport map
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map
+    obs_index : pandas.Index, optional
+        Source cell ids to align the dual variables to.
+    var_index : pandas.Index, optional
+        Destination cell ids to align the dual variables to.
+
+    Returns
+    -------
+    duals : dict or None
+        The dual variables 'u', 'v', 'a', 'b' and 'epsilon'.
+        None if the transport map has no dual variables, or if some of the requested cells are not in the transport map.
+    """
+    if 'ot_epsilon' not in tmap.uns or 'ot_u' not in tmap.obs.columns or 'ot_v' not in tmap.var.columns:
+        return None
+    obs = tmap.obs[['ot_u', 'ot_a']]
+    var = tmap.var[['ot_v', 'ot_b']]
+    if obs_index is not None:
+        obs = obs.reindex(obs_index)
+    if var_index is not None:
+        var = var.reindex(var_index)
+    if obs.isnull().values.any() or var.isnull().values.any():
+        return None
+    return {'u': obs['ot_u'].values, 'a': obs['ot_a'].values, 'v': var['ot_v'].values, 'b': var['ot_b'].values,
+            'epsilon': float(tmap.uns['ot_epsilon'])}
+
+
+SOLVER_TRACE_COLUMNS = ['growth_iteration', 'iteration', 'epsilon', 'row_marginal_error', 'column_marginal_error',
+                        'stabilizations', 'time']
+
+
+def set_solver_trace(tmap, trace):
+    """
+    Store the trace of the OT solver with a transport map
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map. The trace is stored in uns['ot_trace'], one array per column,
+        and is only kept by the h5ad format.
+    trace : list of dict
+        The records returned by the solvers with log=True and trace_stride, see wot.ot.transport_stablev2
+    """
+    trace = pd.DataFrame(trace, columns=SOLVER_TRACE_COLUMNS)
+    tmap.uns['ot_trace'] = {column: trace[column].values for column in trace.columns}
+
+
+def get_solver_trace(tmap):
+    """
+    Retrieve the trace of the OT solver stored with a transport map
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map
+
+    Returns
+    -------
+    trace : pandas.DataFrame or None
+        One row per record, see set_solver_trace. None if the transport map has no trace.
+    """
+    if 'ot_trace' not in tmap.uns:
+        return None
+    trace = tmap.uns['ot_trace']
+    return pd.DataFrame({column: np.asarray(trace[column]) for column in SOLVER_TRACE_COLUMNS if column in trace})
+
+
+def summarize_solver_trace(trace):
+    """
+    Summarize the convergence of a solve from its trace
+
+    Parameters
+    ----------
+    trace : pandas.DataFrame
+        The trace, see get_solver_trace
+
+    Returns
+    -------
+    summary : dict
+        The number of growth and scaling iterations, the final epsilon and marginal errors, the number of
+        stabilizations and the solve time
+    """
+    last = trace.groupby('growth_iteration').last()
+    final = last.iloc[-1]
+    return {'growth_iterations': len(last), 'iterations': int(last['iteration'].sum()),
+            'epsilon': final['epsilon'], 'row_marginal_error': final['row_marginal_error'],
+            'column_marginal_error': final['column_marginal_error'],
+            'stabilizations': int(last['stabilizations'].sum()), 'time': last['time'].sum()}
+
+
+def low_rank_transport_map(tmap, obs, var, densify=True):
+    """
+    Wrap a transport map computed by the nystrom solver in an AnnData
+
+    Parameters
+    ----------
+    tmap : wot.ot.LowRankMatrix
+        The transport map, as the product of its factors
+    obs : pandas.DataFrame
+        The source cells
+    var : pandas.DataFrame
+        The destination cells
+    densify : bool, optional
+        Store the dense transport map in X. Negative entries of the product are clamped to zero and rows rescaled,
+        see LowRankMatrix.toarray. Otherwise X is an empty sparse matrix, see densify_transport_map
+
+    Returns
+    -------
+    tmap : anndata.AnnData
+        The transport map. Its factors are stored in obsm['ot_left'] and varm['ot_right'], and uns['ot_low_rank']
+        is 'densified' if X holds the clamped and rescaled product, or 'factors' if X is empty
+    """
+    X = tmap.toarray() if densify else scipy.sparse.csr_matrix(tmap.shape, dtype=tmap.left.dtype)
+    result = anndata.AnnData(X, obs, var)
+    result.obsm['ot_left'] = np.asarray(tmap.left)
+    result.varm['ot_right'] = np.asarray(tmap.right)
+    result.uns['ot_low_rank'] = 'densified' if densify else 'factors'
+    return result
+
+
+def get_transport_matrix(tmap):
+    """
+    The transport matrix of a transport map : tmap.X, or a wot.ot.LowRankMatrix if only its factors are stored
+    """
+    if tmap.uns.get('ot_low_rank') == 'factors':
+        return wot.ot.LowRankMatrix(np.asarray(tmap.obsm['ot_left']), np.asarray(tmap.varm['ot_right']))
+    return tmap.X
+
+
+def densify_transport_map(tmap):
+    """
+    Compute the dense transport map of a transport map stored as its low-rank factors, see low_rank_transport_map.
+    Other transport maps are returned as is.
+    """
+    if tmap.uns.get('ot_low_rank') != 'factors':
+        return tmap
+    result = anndata.AnnData(get_transport_matrix(tmap).toarray(), tmap.obs, tmap.var)
+    result.obsm['ot_left'] = tmap.obsm['ot_left']
+    result.varm['ot_right'] = tmap.varm['ot_right']
+    result.uns.update(tmap.uns)
+    result.uns['ot_low_rank'] = 'densified'
+    return result
+
+
+def set_cost_geometry(tmap, geometry):
+    """
+    Store the embedding and scale of the cost matrix of a transport map, so that it can be extended with new cells
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map. The geometry is stored in obsm, varm and uns, and is only kept by the h5ad format.
+    geometry : dict
+        The normalization 'scale' of the squared euclidean distances and the ids of the 'genes' they were computed on.
+        With PCA, the coordinates 'x0' and 'x1' of the source and destination cells, scaled by the singular values,
+        the 'pca' and its 'mean_shift', as returned by compute_pca
+    """
+    tmap.uns['ot_cost_scale'] = float(geometry['scale'])
+    tmap.uns['ot_genes'] = np.asarray(geometry['genes'], dtype=str)
+    if geometry.get('pca') is not None:
+        tmap.obsm['ot_x'] = np.asarray(geometry['x0'], dtype=np.float64)
+        tmap.varm['ot_x'] = np.asarray(geometry['x1'], dtype=np.float64)
+        tmap.uns['ot_pca_gene_components'] = np.asarray(geometry['pca'].gene_components_, dtype=np.float64)
+        tmap.uns['ot_pca_singular_values'] = np.asarray(geometry['pca'].singular_values_, dtype=np.float64)
+        tmap.uns['ot_pca_mean_shift'] = np.asarray(geometry['mean_shift'], dtype=np.float64)
+
+
+def get_cost_geometry(tmap):
+    """
+    Retrieve the embedding and scale of the cost matrix stored with a transport map
+
+    Returns
+    -------
+    geometry : dict or None
+        See set_cost_geometry. None if the transport map has no geometry
+    """
+    if 'ot_cost_scale' not in tmap.uns or 'ot_genes' not in tmap.uns:
+        return None
+    geometry = {'scale': float(tmap.uns['ot_cost_scale']), 'genes': pd.Index(np.asarray(tmap.uns['ot_genes'], dtype=str)),
+                'pca': None}
+    if 'ot_pca_gene_components' in tmap.uns:
+        if 'ot_x' not in tmap.obsm.keys() or 'ot_x' not in tmap.varm.keys():
+            return None
+        geometry['pca'] = wot.ot.TruncatedPCA(None, np.asarray(tmap.uns['ot_pca_singular_values']), None,
+                                              np.asarray(tmap.uns['ot_pca_gene_components']))
+        geometry['mean_shift'] = np.asarray(tmap.uns['ot_pca_mean_shift'])
+        geometry['x0'] = np.asarray(tmap.obsm['ot_x'])
+        geometry['x1'] = np.asarray(tmap.varm['ot_x'])
+    return geometry
+
+
+def extend_transport_map(tmap, p0, p1):
+    """
+    Add rows for new source cells and columns for new destination cells to a transport map, without solving again.
+
+    The dual potential of each new cell is the entropic c-transform of the stored potentials of the other timepoint,
+    shifted so that its row (or column) has the average mass of the existing ones.
+    Costs are computed in the embedding the transport map was computed in, with the same normalization,
+    see set_cost_geometry. New cells are projected on the stored PCA, so that the cost of an extension only
+    depends on the number of new cells.
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map, with its dual variables and cost geometry, see set_duals and set_cost_geometry
+    p0 : anndata.AnnData
+        The source cells, both those of the transport map and the new ones
+    p1 : anndata.AnnData
+        The destination cells, both those of the transport map and the new ones
+
+    Returns
+    -------
+    tmap : anndata.AnnData
+        The transport map with the new cells appended, and their dual variables and coordinates
+
+    Raises
+    ------
+    ValueError
+        If the dual variables or the cost geometry are not stored with the transport map, as for transport maps
+        computed in loom format or with another cost than the default cost matrix
+    """
+    duals = get_duals(tmap)
+    if duals is None:
+        raise ValueError("No dual variables stored with the transport map. Recompute it in h5ad format")
+    geometry = get_cost_geometry(tmap)
+    if geometry is None:
+        raise ValueError("No cost geometry stored with the transport map. "
+                         "Recompute it in h5ad format with the default cost matrix")
+    genes = geometry['genes']
+    if not genes.isin(p0.var.index).all():
+        raise ValueError("Genes of the transport map missing from the expression matrix")
+    new0 = p0[~p0.obs.index.isin(tmap.obs.index)]
+    new1 = p1[~p1.obs.index.isin(tmap.var.index)]
+    new0, new1 = [new[:, new.var.index.get_indexer(genes)] for new in (new0, new1)]
+    pca = geometry['pca']
+    if pca is not None:
+        x0, x1 = geometry['x0'], geometry['x1']
+        y0, y1 = [wot.ot.project_on_pca(pca, geometry['mean_shift'], new.X) * pca.singular_values_
+                  for new in (new0, new1)]
+    else:
+        x0, x1 = [ds[index][:, ds.var.index.get_indexer(genes)].X for ds, index in ((p0, tmap.obs.index),
+                                                                                   (p1, tmap.var.index))]
+        x0, x1, y0, y1 = [x.toarray() if scipy.sparse.isspmatrix(x) else np.asarray(x)
+                          for x in (x0, x1, new0.X, new1.X)]
+    median = geometry['scale']
+    epsilon = duals['epsilon']
+    u, v = wot.ot.absorb_duals(duals)
+    X = tmap.X
+    stack = scipy.sparse.vstack if scipy.sparse.issparse(X) else np.vstack
+
+    if new0.shape[0] > 0:
+        log_rows = (v - sklearn.metrics.pairwise.pairwise_distances(y0, x1, metric='sqeuclidean') / median) / epsilon
+        mass = np.asarray(X.sum(axis=1)).mean()
+        u_new = epsilon * (np.log(mass) - scipy.special.logsumexp(log_rows, axis=1))
+        X = stack((X, np.exp(log_rows + u_new[:, np.newaxis] / epsilon).astype(X.dtype)))
+        u, x0 = np.concatenate((u, u_new)), np.vstack((x0, y0))
+    if new1.shape[0] > 0:
+        log_columns = (u[:, np.newaxis] - sklearn.metrics.pairwise.pairwise_distances(
+            x0, y1, metric='sqeuclidean') / median) / epsilon
+        mass = np.asarray(X.sum(axis=0)).mean()
+        v_new = epsilon * (np.log(mass) - scipy.special.logsumexp(log_columns, axis=0))
+        X = stack((X.T, np.exp(log_columns + v_new / epsilon).astype(X.dtype).T)).T
+        v, x1 = np.concatenate((v, v_new)), np.vstack((x1, y1))
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+
+    obs = pd.concat((tmap.obs, new0.obs.reindex(columns=tmap.obs.columns)))
+    var = pd.concat((tmap.var, new1.obs.reindex(columns=tmap.var.columns)))
+    result = anndata.AnnData(X, obs, var)
+    set_duals(result, {'u': u, 'a': np.ones(len(u)), 'v': v, 'b': np.ones(len(v)), 'epsilon': epsilon})
+    if pca is not None:
+        geometry['x0'], geometry['x1'] = x0, x1
+    set_cost_geometry(result, geometry)
+    return result
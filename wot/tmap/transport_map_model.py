@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 
 import wot.io
+import wot.ot
 import wot.tmap
 from wot.population import Population
 
@@ -94,7 +95,8 @@ class TransportMapModel:
         Returns
         -------
         tmap : anndata.AnnData
-            The transport map from t0 to t1
+            The transport map from t0 to t1.
+            Transport maps stored as their low-rank factors are densified, see wot.ot.densify_transport_map
         """
         if t0 not in self.timepoints or t1 not in self.timepoints:
             raise ValueError("Timepoints {}, {} not found".format(t0, t1))
@@ -115,8 +117,8 @@ class TransportMapModel:
             if ds_or_path is None:
                 raise ValueError('No transport map found for {}', key)
             if type(ds_or_path) is anndata.AnnData:
-                return ds_or_path
-            ds = wot.io.read_dataset(ds_or_path)
+                return wot.ot.densify_transport_map(ds_or_path)
+            ds = wot.ot.densify_transport_map(wot.io.read_dataset(ds_or_path))
             if self.cache:
                 self.tmaps[key] = ds
             return ds
@@ -544,6 +546,54 @@ class TransportMapModel:
 
         return census
 
+    def extend_with_cells(self, matrix, day):
+        """
+        Adds new cells at a timepoint to the transport maps from and to that timepoint, without recomputing them.
+        The transport maps are updated in place, see wot.ot.extend_transport_map.
+        Their files are replaced atomically, and marked as extended in the manifest of their directory,
+        so that OTModel computes them exactly again instead of taking them for solved ones, see OTModel.update_manifest.
+
+        Parameters
+        ----------
+        matrix : anndata.AnnData
+            The gene expression matrix, with a day column. It must contain the cells of the transport maps
+            involving the timepoint, as well as the new cells.
+        day : int or float
+            The timepoint of the new cells
+
+        Returns
+        -------
+        new_ids : pandas.Index
+            The ids of the cells added to the transport maps
+        """
+        if day not in self.timepoints:
+            raise ValueError("Timepoint {} not found".format(day))
+        new_ids = matrix.obs.index[(matrix.obs['day'] == day) & ~matrix.obs.index.isin(self.meta.index)]
+        if len(new_ids) == 0:
+            return new_ids
+        for key in list(self.tmaps.keys()):
+            if len(key) != 2 or day not in key:
+                continue
+            tmap = self.get_transport_map(*key)
+            p0 = matrix[matrix.obs.index.isin(tmap.obs.index) | (matrix.obs.index.isin(new_ids) & (day == key[0]))]
+            p1 = matrix[matrix.obs.index.isin(tmap.var.index) | (matrix.obs.index.isin(new_ids) & (day == key[1]))]
+            tmap = wot.ot.extend_transport_map(tmap, p0, p1)
+            path = self.tmaps[key]
+            if type(path) is anndata.AnnData or self.cache:
+                self.tmaps[key] = tmap
+            if type(path) is not anndata.AnnData:
+                wot.ot.OTModel.write_transport_map(tmap, path, os.path.splitext(path)[1][1:])
+                directory, name = os.path.split(os.path.splitext(path)[0])
+                manifest_file = os.path.join(directory, name.rsplit('_', 2)[0] + '_manifest.json')
+                if os.path.exists(manifest_file):
+                    wot.ot.OTModel.update_manifest_file(manifest_file, {name: 'extended'})
+
+        # keep the cells of each timepoint in the order of the transport maps
+        position = np.where(self.meta['day'] == day)[0][-1] + 1
+        self.meta = pd.concat((self.meta.iloc[:position], pd.DataFrame(index=new_ids, data={'day': day}),
+                               self.meta.iloc[position:]), copy=False)
+        return new_ids
+
     def to_json(self, path):
         import json
         meta = self.meta.to_dict(orient='list')
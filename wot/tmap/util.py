@@ -43,5 +43,5 @@ def glue_transport_maps(tmap_0, tmap_1):
     # FIXME: Column sum normalization is needed before gluing. Can be skipped only if lambda2 is high enough
     cells_at_intermediate_tpt = tmap_0.var.index
     cait_index = tmap_1.obs.index.get_indexer_for(cells_at_intermediate_tpt)
-    result_x = np.dot(tmap_0.X, tmap_1.X[cait_index, :])
+    result_x = tmap_0.X @ tmap_1.X[cait_index, :]
     return anndata.AnnData(result_x, tmap_0.obs.copy(), tmap_1.var.copy())